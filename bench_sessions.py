@@ -0,0 +1,143 @@
+import subprocess
+import threading
+import socket
+import json
+import time
+import sys
+import gc
+import os
+
+# bytes per idle chat connection on the server, measured in a process of
+# its own per size with the connections coming from another process:
+# python bench_sessions.py [connections ...]
+# rss/conn   growth of the resident size, thread stacks included
+# heap/conn  Python allocations (tracemalloc), thread objects included
+# accounted  what /memory reports without the reserved thread stacks:
+#            session state, thread objects and buffered frames
+# threads    threads started per connection
+
+SIZES = (1000, 10000, 50000)
+# time for the connections to settle before measuring
+SETTLE_TIME = 2
+
+
+def raise_file_limit(needed) -> bool:
+    # every connection is a file descriptor, ask for as many as allowed
+    try:
+        import resource
+    except ImportError:
+        return True
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    return wanted >= needed
+
+
+def resident_memory() -> int:
+    # resident set size of this process, 0 where it cannot be read
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def measure(size, heap) -> dict:
+    # accept size connections as idle chat sessions and report what they cost
+    if heap:
+        import tracemalloc
+        tracemalloc.start()
+    import server
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    if not raise_file_limit(size + 64):
+        return {'size': size, 'error': 'not enough file descriptors'}
+    connector = subprocess.Popen(
+        [sys.executable, __file__, '--connect',
+         str(listener.getsockname()[1]), str(size)],
+        stdin=subprocess.PIPE)
+    gc.collect()
+    threads = threading.active_count()
+    rss = resident_memory()
+    traced = tracemalloc.get_traced_memory()[0] if heap else 0
+    reached = 0
+    try:
+        while reached < size:
+            client_socket, address = listener.accept()
+            # the same state on_connect sets up, without the join
+            # broadcasts to every other client
+            session = server.start_session(
+                client_socket, address, f'user{reached}'.encode('utf-8'))
+            threading.Thread(target=server.handle,
+                             args=(client_socket, session), daemon=True).start()
+            reached += 1
+    except (OSError, RuntimeError) as error:
+        # out of threads or descriptors, report what was reached
+        failure = str(error)
+    else:
+        failure = None
+    time.sleep(SETTLE_TIME)
+    gc.collect()
+    result = {
+        'size': size,
+        'reached': reached,
+        'rss': (resident_memory() - rss) / max(reached, 1),
+        'threads': (threading.active_count() - threads) / max(reached, 1),
+        'accounted': sum(session.memory()['objects'] + session.memory()['frames']
+                         for session in list(server.CLIENTS.values())) / max(reached, 1),
+    }
+    if heap:
+        result['heap'] = (tracemalloc.get_traced_memory()[0] - traced) / max(reached, 1)
+    if failure:
+        result['error'] = failure
+    connector.kill()
+    return result
+
+
+def connect(port, size) -> None:
+    # open the connections and hold them until told to stop
+    raise_file_limit(size + 64)
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(socket.create_connection(('127.0.0.1', port)))
+    except OSError:
+        pass
+    sys.stdin.read()
+
+
+def run(size, heap) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, '--measure', str(size), str(int(heap))],
+        capture_output=True, text=True)
+    try:
+        return json.loads(output.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return {'size': size, 'error': output.stderr.strip().splitlines()[-1]
+                if output.stderr.strip() else 'no result'}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        print(json.dumps(measure(int(sys.argv[2]), sys.argv[3] == '1')))
+        os._exit(0)
+    if sys.argv[1:2] == ['--connect']:
+        connect(int(sys.argv[2]), int(sys.argv[3]))
+        sys.exit(0)
+
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    print(f'{"connections":>12}{"rss/conn":>12}{"heap/conn":>12}'
+          f'{"accounted":>12}{"threads":>9}')
+    for size in sizes:
+        # tracemalloc inflates the resident size, so heap is measured
+        # in a second run
+        result = run(size, False)
+        heap = run(size, True) if 'reached' in result else {}
+        if 'reached' in result:
+            print(f'{result["reached"]:>12}{result["rss"]:>12.0f}'
+                  f'{heap.get("heap", 0):>12.0f}{result["accounted"]:>12.0f}'
+                  f'{result["threads"]:>9.1f}')
+        if 'error' in result:
+            print(f'{size:>12}  stopped: {result["error"]}')
@@ -6,6 +6,14 @@ import socket
 import sys
 import os
 import ntpath
+import time
+import random
+import uuid
+import hashlib
+import mmap
+import struct
+import zlib
+import mux
 from PySide6.QtWidgets import (QApplication, QLineEdit, QPlainTextEdit, QPushButton, QVBoxLayout, QFileDialog,
                                QScrollArea, QSizePolicy, QTextBrowser, QWidget, QLabel, QListWidget, QListWidgetItem)
 from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
@@ -132,10 +140,10 @@ class ConnectFormGUI(QWidget):
 
     def connect(self):
         try:
-            chat_socket.connect((self.ui.host_input.text(),
-                                 int(self.ui.port_input.text())))
-            global server_host
+            global chat_socket, server_host, server_port
             server_host = self.ui.host_input.text()
+            server_port = int(self.ui.port_input.text())
+            chat_socket = open_connection(b'chat')
             name_gui.show()
             self.close()
         except:
@@ -252,12 +260,18 @@ class NameFormGUI(QWidget):
         try:
             nickname = self.ui.nickname_input.text()
             chat_socket.send(nickname.encode('utf-8'))
-            message = chat_socket.recv(1024).decode('utf-8')
+            message = recv_frame(chat_socket).decode(
+                'utf-8').rstrip('\x00')
             if message == 'RESEND_NICK':
                 self.ui.warning_label.setText(
                     "Nickname already in use!")
                 return
-            global user_name
+            # the session token is frame 1 of the session, keep it
+            # to pick up where we left off after losing the connection
+            global user_name, session_token, received_frames
+            session_token = session_pattern.match(message).group(1)
+            received_frames = 1
+            message = recv_chat_frame().decode('utf-8').rstrip('\x00')
             user_name = self.ui.nickname_input.text().encode('utf-8')
             chat_room.ui.textBrowser.append(message)
             chat_room.start_room()
@@ -360,6 +374,8 @@ class ChatRoomGUI(QWidget):
     quit_pattern = re.compile(r'^\s*/quit\s*$')
     clear_pattern = re.compile(r'^\s*/clear\s*$')
     private_pattern = re.compile(r'^\s*/private.*$')
+    p2p_pattern = re.compile(r'^\s*/p2p\s*$')
+    search_pattern = re.compile(r'^\s*/search(\s.*)?$')
     null_pattern = re.compile(r'^[\s\n]*$')
 
     def __init__(self, parent=None) -> None:
@@ -398,7 +414,7 @@ class ChatRoomGUI(QWidget):
             if item.text() != user_name.decode('utf-8') + " (You)" else None)
 
         self.ui.file_list.itemClicked.connect(
-            lambda item: self.download_file(item.data(Qt.UserRole))
+            lambda item: self.download_file(item)
         )
 
     def eventFilter(self, watched: QObject, event: any) -> bool:
@@ -426,6 +442,10 @@ class ChatRoomGUI(QWidget):
                 "/quit: Leave the chatroom\n")
             self.ui.textBrowser.append(
                 "/clear: Clear the chat history\n")
+            self.ui.textBrowser.append(
+                "/p2p: Share files straight from your machine (on/off)\n")
+            self.ui.textBrowser.append(
+                "/search [(<page>)] <words>: Search messages and file names\n")
             self.ui.textBrowser.append(
                 "--------------------------------------------------------------------------------\n")
             self.ui.plainTextEdit.clear()
@@ -434,12 +454,19 @@ class ChatRoomGUI(QWidget):
             ctypes.windll.user32.MessageBoxW(
                 0, "You have left the chatroom!", "Info", 0)
             self.close()
-            chat_socket.close()
+            leave_room()
             sys.exit(0)
         if self.clear_pattern.match(message):
             self.ui.textBrowser.clear()
             self.ui.plainTextEdit.clear()
             return
+        if self.p2p_pattern.match(message):
+            global p2p_mode
+            p2p_mode = not p2p_mode
+            self.ui.textBrowser.append(
+                f"---- P2P sharing is {'on' if p2p_mode else 'off'}\n")
+            self.ui.plainTextEdit.clear()
+            return
         if self.private_pattern.match(message):
             valid_private_pattern = re.compile(
                 r"^[\n\s]*(/private)\s+\((.{2,16})\)\s+(.+)$")
@@ -464,6 +491,11 @@ class ChatRoomGUI(QWidget):
                 self.ui.textBrowser.append(
                     "---- Usage: /private (<username>) <message>\n")
                 return
+        if self.search_pattern.match(message):
+            # results come back to this client only
+            send_to_server(chat_socket, message)
+            self.ui.plainTextEdit.clear()
+            return
         if self.null_pattern.match(message):
             self.ui.plainTextEdit.clear()
             return
@@ -480,58 +512,166 @@ class ChatRoomGUI(QWidget):
             self.ui.pushButton.setEnabled(False)
 
     def upload_file(self) -> None:
-        upload_socket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
+        # open dialog to choose file
+        # save absolute path of the file
+        file_path = QFileDialog.getOpenFileName(
+            self, "Open File", "", "All Files (*.*)")[0]
+        # check if file name is valid
+        if not file_path:
+            return
+        if p2p_mode:
+            self.share_file(os.path.abspath(file_path))
+            return
+        # a file shared under the same name before is the base of a delta
+        base_token = None
+        for row in range(self.ui.file_list.count()):
+            item = self.ui.file_list.item(row)
+            if item.text() == ntpath.basename(file_path) and not item.data(Qt.UserRole + 1):
+                base_token = item.data(Qt.UserRole)
+        # transfers may wait in the server queue, keep the window responsive
+        upload_thread = threading.Thread(
+            target=self._upload_file_, args=(os.path.abspath(file_path), None, base_token))
+        upload_thread.start()
+
+    def _upload_file_(self, file_path, relay_token=None, base_token=None) -> None:
+        upload_socket = None
         try:
-            upload_socket.connect((server_host, 8080))
-            # open dialog to choose file
-            # save absolute path of the file
-            file_path = os.path.abspath(
-                QFileDialog.getOpenFileName(self, "Open File", "", "All Files (*.*)")[0])
+            upload_socket = open_connection(b'upload')
             # extract file name from file path
             file_name = ntpath.basename(file_path)
-            # check if file name is valid
-            if not file_name:
-                return
+            file_size = os.path.getsize(file_path)
             # send metadata to server
-            send_to_server(upload_socket,
-                           f"/upload ({user_name.decode('utf-8')}) ({file_name})")
+            if base_token is not None:
+                # a new version, only the changed blocks are sent
+                send_to_server(upload_socket,
+                               f"/delta ({user_name.decode('utf-8')}) ({file_name}) ({file_size}) ({base_token})")
+            elif relay_token is None:
+                send_to_server(upload_socket,
+                               f"/upload ({user_name.decode('utf-8')}) ({file_name}) ({file_size})")
+            else:
+                # a copy of a P2P file for users who cannot reach this machine
+                send_to_server(upload_socket,
+                               f"/relay ({user_name.decode('utf-8')}) ({relay_token}) ({file_size})")
             # receive signal from server to start sending file content
-            signal = upload_socket.recv(1024).decode('utf-8')
+            signal = self.wait_for_transfer(upload_socket, file_name)
+            if signal == "READY" and base_token is not None:
+                # signatures of the blocks the server already has
+                header = recv_frame(upload_socket).decode('utf-8').rstrip('\x00')
+                block_size, count = map(
+                    int, signature_header_pattern.match(header).groups())
+                signatures = recv_exact(upload_socket, count * SIGNATURE.size)
+                digest, sent = send_delta(
+                    upload_socket, file_path, file_size, block_size, signatures)
+                self.ui.textBrowser.append(
+                    f"---- {file_name}: sent {sent} of {file_size} bytes, the rest was already on the server\n")
+            elif signal == "READY":
+                digest = send_file(upload_socket, file_path, file_size)
             if signal == "READY":
-                with open(file_path, 'rb') as file:
-                    file_data = file.read()
-                    upload_socket.sendall(file_data)
+                # the server checks the content against this digest
+                send_to_server(upload_socket, f"({digest})")
+                if recv_frame(upload_socket).decode('utf-8').rstrip('\x00') == "DAMAGED":
+                    self.ui.textBrowser.append(
+                        "             ------   ERROR: The file was damaged on the way, please upload it again   ------             \n")
+            elif signal == "RATE_LIMITED":
+                self.ui.textBrowser.append(
+                    "                ------   Too many uploads, please wait a moment and try again   ------                \n")
+            elif signal == "QUOTA_EXCEEDED":
+                self.ui.textBrowser.append(
+                    "                  ------   Not enough storage on the server for this file   ------                  \n")
         except:
             self.ui.textBrowser.append(
                 "                           ------   Cannot connect to the server!   ------                           \n")
         finally:
-            upload_socket.close()
+            if upload_socket is not None:
+                upload_socket.close()
 
-    def download_file(self, token) -> None:
-        download_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def download_file(self, item) -> None:
+        save_path = QFileDialog.getSaveFileName(
+            self, "Save File", item.text(), f"")[0]
+        if not ntpath.basename(save_path):
+            return
+        if item.data(Qt.UserRole + 1):
+            # ask the server where the owner can be reached
+            pending_fetches[item.data(Qt.UserRole)] = save_path
+            send_to_server(chat_socket, f"/fetch ({item.data(Qt.UserRole)})")
+            return
+        # transfers may wait in the server queue, keep the window responsive
+        download_thread = threading.Thread(
+            target=self._download_file_, args=(item.data(Qt.UserRole), save_path))
+        download_thread.start()
+
+    def _download_file_(self, token, save_path) -> None:
+        download_socket = None
         try:
-            download_socket.connect((server_host, 9000))
-            download_socket.send(token.encode('utf-8'))
-            file_name = download_socket.recv(1024).decode('utf-8')
-            save_path = QFileDialog.getSaveFileName(
-                self, "Save File", file_name, f"")[0]
-            if not ntpath.basename(save_path):
-                return
-            with open(save_path, 'wb') as file:
-                while True:
-                    data = download_socket.recv(1024)
-                    if not data:
-                        break
-                    file.write(data)
-                file.close()
+            download_socket = open_connection(b'download')
+            send_to_server(download_socket,
+                           f"/download ({user_name.decode('utf-8')}) ({token})")
+            # the server answers with (filename) (size) (digest)
+            # once the transfer starts
+            header = self.wait_for_transfer(
+                download_socket, ntpath.basename(save_path))
+            _, size, digest = download_header_pattern.match(header).groups()
+            if receive_file(download_socket, save_path, int(size)) != digest:
+                os.remove(save_path)
                 self.ui.textBrowser.append(
-                    "                      ------   File has been saved to your machine   -----                      \n")
+                    "            ------   ERROR: The file was damaged on the way, please download it again   ------            \n")
+                return
+            self.ui.textBrowser.append(
+                "                      ------   File has been saved to your machine   -----                      \n")
         except:
             self.ui.textBrowser.append(
                 "                   ------   ERROR: Failed to download attachment   ------                  \n")
         finally:
-            download_socket.close()
+            if download_socket is not None:
+                download_socket.close()
+
+    def share_file(self, file_path) -> None:
+        # offer the file from this machine, the server only announces it
+        global peer_server
+        if peer_server is None:
+            peer_server = PeerServer()
+        token = uuid.uuid4().hex
+        peer_server.files[token] = file_path
+        send_to_server(chat_socket,
+                       f"/share ({token}) ({os.path.getsize(file_path)}) ({peer_server.port}) ({ntpath.basename(file_path)})")
+
+    def _fetch_from_peer_(self, token, host, port, ticket) -> None:
+        save_path = pending_fetches.get(token)
+        if save_path is None:
+            return
+        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            peer_socket.settimeout(PEER_TIMEOUT)
+            peer_socket.connect((host, port))
+            send_to_server(peer_socket, ticket)
+            header = recv_frame(peer_socket).decode('utf-8').rstrip('\x00')
+            size = int(peer_header_pattern.match(header).group(2))
+            digest = receive_file(peer_socket, save_path, size)
+            # the owner follows the content with its digest
+            trailer = recv_frame(peer_socket).decode('utf-8').rstrip('\x00')
+            if trailer != f"({digest})":
+                os.remove(save_path)
+                raise ConnectionError('file damaged on the way')
+            del pending_fetches[token]
+            self.ui.textBrowser.append(
+                "                      ------   File has been saved to your machine   -----                      \n")
+        except:
+            # go through the server instead
+            self.ui.textBrowser.append(
+                "---- Cannot reach the owner directly, fetching the file through the server\n")
+            send_to_server(chat_socket, f"/fallback ({token})")
+        finally:
+            peer_socket.close()
+
+    def wait_for_transfer(self, transfer_socket, file_name) -> str:
+        # report the queue position until the server lets the transfer start
+        while True:
+            signal = recv_frame(transfer_socket).decode('utf-8').rstrip('\x00')
+            queued = queued_pattern.match(signal)
+            if not queued:
+                return signal
+            self.ui.textBrowser.append(
+                f"---- {file_name} is waiting for a free transfer slot, position {queued.group(1)} in queue\n")
 
     def update_user_list(self, update=None) -> None:
         if update:
@@ -547,12 +687,21 @@ class ChatRoomGUI(QWidget):
                 item.setFont(self.font)
                 self.ui.user_list.addItem(item)
 
-    def update_file_list(self, file_name, token) -> None:
+    def update_file_list(self, file_name, token, peer=False, digest=None) -> None:
         item = QListWidgetItem(file_name.decode('utf-8'))
         item.setFont(self.font)
+        if digest:
+            item.setToolTip(f"BLAKE2b: {digest.decode('utf-8')}")
         item.setData(Qt.UserRole, token.decode('utf-8'))
+        item.setData(Qt.UserRole + 1, peer)
         self.ui.file_list.addItem(item)
 
+    def remove_file_list(self, token) -> None:
+        for row in range(self.ui.file_list.count()):
+            if self.ui.file_list.item(row).data(Qt.UserRole) == token.decode('utf-8'):
+                self.ui.file_list.takeItem(row)
+                return
+
     def start_room(self) -> None:
 
         self.ui.textBrowser.append(
@@ -568,29 +717,296 @@ class ChatRoomGUI(QWidget):
 # ---------------------------------------------------TCP Socket Programming----------------------------------------------------
 
 
+def frame_message(message: str) -> list:
+    # split the message into FRAME_SIZE-byte frames and pad the last one
+    # a multi-byte character is never split across two frames
+    data = message.encode('utf-8')
+    frames = []
+    while len(data) > FRAME_SIZE:
+        cut = FRAME_SIZE
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        frames.append(data[:cut].ljust(FRAME_SIZE, b'\x00'))
+        data = data[cut:]
+    frames.append(data.ljust(FRAME_SIZE, b'\x00'))
+    return frames
+
+
 def send_to_server(client_socket, message: str) -> None:
-    if len(message) < 1024:
-        message = message + (1024-len(message))*'\x00'
-        client_socket.send(message.encode('utf-8'))
-    else:
-        message_list = []
-        while len(message) > 1024:
-            message_list.append(message[:1024])
-            message = message[1024:]
-        message_list.append(message + (1024-len(message))*'\x00')
-        if len(message):
-            message_list.append(message + (1024-len(message))*'\x00')
-        for message in message_list:
-            client_socket.send(message.encode('utf-8'))
+    # all frames of a message leave in a single send
+    client_socket.sendall(b''.join(frame_message(message)))
+
+
+def recv_exact(client_socket, size) -> bytes:
+    # the stream may deliver the data in several pieces
+    data = bytearray()
+    while len(data) < size:
+        chunk = client_socket.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(client_socket) -> bytes:
+    # read exactly one frame
+    return recv_exact(client_socket, FRAME_SIZE)
+
+
+def send_file(transfer_socket, file_path, size) -> str:
+    # stream size bytes of the file and return their digest
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    sent = 0
+    with open(file_path, 'rb') as file:
+        while sent < size:
+            data = file.read(min(TRANSFER_CHUNK, size - sent))
+            if not data:
+                raise OSError('file changed while sending')
+            transfer_socket.sendall(data)
+            digest.update(data)
+            sent += len(data)
+    return digest.hexdigest()
+
+
+def send_delta(transfer_socket, file_path, size, block_size, signatures) -> tuple:
+    # rsync-style delta: slide a window over the file with a rolling
+    # checksum and send a reference for every block the server already
+    # has, the bytes in between go out as literals
+    # return the digest of the whole file and the literal bytes sent
+    blocks = dict()
+    for index in range(len(signatures) // SIGNATURE.size):
+        weak, strong = SIGNATURE.unpack_from(signatures, index * SIGNATURE.size)
+        blocks.setdefault(weak, dict()).setdefault(strong, index)
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    instructions = bytearray()
+    sent = 0
+
+    def add_literal(begin, end) -> None:
+        # content[begin:end] goes out one chunk at a time, a file without
+        # any known block is never held in memory as a whole
+        nonlocal sent
+        for start in range(begin, end, TRANSFER_CHUNK):
+            literal = content[start:min(start + TRANSFER_CHUNK, end)]
+            instructions.extend(DELTA_HEADER.pack(b'L', len(literal)))
+            instructions.extend(literal)
+            digest.update(literal)
+            flush()
+        sent += end - begin
+
+    def flush() -> None:
+        if len(instructions) >= TRANSFER_CHUNK:
+            transfer_socket.sendall(instructions)
+            instructions.clear()
+
+    with open(file_path, 'rb') as file:
+        content = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if size else b''
+        try:
+            position = literal = 0
+            # bytes left to roll, blocks left to probe and the next stride
+            rolling, probes, stride = block_size * DELTA_ROLL, 1, 1
+            weak = zlib.adler32(content[0:block_size])
+            while blocks and position + block_size <= size:
+                candidates = blocks.get(weak)
+                match = None
+                if candidates:
+                    match = candidates.get(hashlib.blake2b(
+                        content[position:position + block_size], digest_size=16).digest())
+                if match is not None:
+                    if literal < position:
+                        add_literal(literal, position)
+                    instructions.extend(DELTA_HEADER.pack(b'B', match))
+                    digest.update(content[position:position + block_size])
+                    position = literal = position + block_size
+                    weak = zlib.adler32(content[position:position + block_size])
+                    rolling, probes, stride = block_size * DELTA_ROLL, 1, 1
+                    flush()
+                    continue
+                if rolling:
+                    # roll the window one byte further
+                    if position + block_size < size:
+                        a, b = weak & 0xffff, weak >> 16
+                        out, new = content[position], content[position + block_size]
+                        a = (a - out + new) % 65521
+                        b = (b - block_size * out + a - 1) % 65521
+                        weak = (b << 16) | a
+                    position += 1
+                    rolling -= 1
+                else:
+                    # new content, probe block by block for a while, then
+                    # roll one window to find the alignment again, the
+                    # strides double so a long run of new content is mostly
+                    # probed and a short one costs little more than itself
+                    position += block_size
+                    weak = zlib.adler32(content[position:position + block_size])
+                    probes -= 1
+                    if not probes:
+                        stride = min(stride * 2, DELTA_STRIDE)
+                        rolling, probes = block_size, stride
+                if position - literal >= TRANSFER_CHUNK:
+                    add_literal(literal, position)
+                    literal = position
+            if literal < size:
+                add_literal(literal, size)
+        finally:
+            if size:
+                content.close()
+    instructions.extend(DELTA_HEADER.pack(b'E', 0))
+    transfer_socket.sendall(instructions)
+    return digest.hexdigest(), sent
+
+
+def receive_file(transfer_socket, save_path, size) -> str:
+    # write size bytes to save_path and return their digest
+    # the content is hashed as it is written, never read back
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    received = 0
+    with open(save_path, 'wb') as file:
+        while received < size:
+            data = transfer_socket.recv(min(TRANSFER_CHUNK, size - received))
+            if not data:
+                break
+            file.write(data)
+            digest.update(data)
+            received += len(data)
+    if received != size:
+        os.remove(save_path)
+        raise ConnectionError('transfer cut short')
+    return digest.hexdigest()
+
+
+class PeerServer:
+    # serves files shared in P2P mode straight from this machine
+    # to clients holding a one-time ticket handed out by the server
+    def __init__(self) -> None:
+        # token: file path
+        self.files = dict()
+        # ticket: token
+        self.tickets = dict()
+        self.condition = threading.Condition()
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.bind(('', 0))
+        self.server_socket.listen()
+        self.port = self.server_socket.getsockname()[1]
+        accept_thread = threading.Thread(target=self.accept, daemon=True)
+        accept_thread.start()
+
+    def allow(self, token, ticket) -> None:
+        with self.condition:
+            self.tickets[ticket] = token
+            self.condition.notify_all()
+
+    def accept(self) -> None:
+        while True:
+            try:
+                peer_socket, _ = self.server_socket.accept()
+                serve_thread = threading.Thread(
+                    target=self.serve, args=(peer_socket,), daemon=True)
+                serve_thread.start()
+            except:
+                break
+
+    def serve(self, peer_socket) -> None:
+        try:
+            peer_socket.settimeout(PEER_TIMEOUT)
+            ticket = recv_frame(peer_socket).decode('utf-8').rstrip('\x00')
+            with self.condition:
+                # the peer may connect before the server's ticket arrives
+                self.condition.wait_for(
+                    lambda: ticket in self.tickets, PEER_TIMEOUT)
+                token = self.tickets.pop(ticket, None)
+            if token not in self.files:
+                return
+            file_path = self.files[token]
+            file_size = os.path.getsize(file_path)
+            send_to_server(peer_socket,
+                           f"({ntpath.basename(file_path)}) ({file_size})")
+            digest = send_file(peer_socket, file_path, file_size)
+            send_to_server(peer_socket, f"({digest})")
+        except:
+            return
+        finally:
+            peer_socket.close()
+
+
+def recv_chat_frame() -> bytes:
+    # count the frames of the session, the server replays the ones
+    # after this number when we reconnect
+    global received_frames
+    message = recv_frame(chat_socket)
+    received_frames += 1
+    return message
+
+
+def open_connection(channel) -> socket.socket:
+    # a TCP connection to the listener of the channel, or in multiplexed
+    # mode (python client.py --mux) a new stream of the one connection
+    # kept to the chat port
+    global multiplexer
+    if MULTIPLEX:
+        if multiplexer is None or multiplexer.closed:
+            multiplexer = mux.connect(server_host, server_port)
+        return multiplexer.open(channel)
+    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if channel == b'chat':
+            # chat messages are small and latency sensitive, do not wait for Nagle
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.connect((server_host, TRANSFER_PORTS.get(channel, server_port)))
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+def leave_room() -> None:
+    # closing on purpose, do not try to resume the session
+    global leaving
+    leaving = True
+    if chat_socket is not None:
+        if session_token:
+            # without it the server keeps the session for a while
+            # in case the connection only dropped
+            try:
+                send_to_server(chat_socket, '\x00LEAVE')
+                chat_socket.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        chat_socket.close()
+    if multiplexer is not None:
+        multiplexer.close()
+
+
+def reconnect() -> bool:
+    # resume the session on a new connection without leaving the room
+    global chat_socket
+    for attempt in range(RECONNECT_ATTEMPTS):
+        # back off exponentially, with jitter so clients dropped together
+        # do not all come back at the same moment
+        delay = min(RECONNECT_DELAY * 2 ** attempt, RECONNECT_MAX_DELAY)
+        time.sleep(delay * random.uniform(0.5, 1))
+        new_socket = None
+        try:
+            new_socket = open_connection(b'chat')
+            new_socket.send(
+                f"\x00RESUME ({session_token}) ({received_frames})".encode('utf-8'))
+            if recv_frame(new_socket).rstrip(b'\x00') != b'\x00RESUMED':
+                new_socket.close()
+                return False
+            chat_socket.close()
+            chat_socket = new_socket
+            return True
+        except OSError:
+            if new_socket is not None:
+                new_socket.close()
+    return False
 
 
 def receive() -> None:
     while True:
         try:
-            message = chat_socket.recv(1024)
-            if len(message) < 1024:
-                continue
-            elif update_pattern.match(message):
+            message = recv_chat_frame()
+            if update_pattern.match(message):
                 new_user = update_pattern.match(message).group(1)
                 online_users.add(new_user)
                 chat_room.update_user_list(update=new_user)
@@ -601,8 +1017,53 @@ def receive() -> None:
                 chat_room.update_user_list()
                 continue
             elif new_file_pattern.match(message):
-                file_name, token = new_file_pattern.match(message).groups()
-                chat_room.update_file_list(file_name, token)
+                file_name, token, digest = new_file_pattern.match(
+                    message).groups()
+                chat_room.update_file_list(file_name, token, digest=digest)
+                continue
+            elif new_peer_file_pattern.match(message):
+                file_name, token = new_peer_file_pattern.match(
+                    message).groups()
+                chat_room.update_file_list(file_name, token, peer=True)
+                continue
+            elif peer_pattern.match(message):
+                token, host, port, ticket = peer_pattern.match(
+                    message).groups()
+                fetch_thread = threading.Thread(target=chat_room._fetch_from_peer_, args=(
+                    token.decode('utf-8'), host.decode('utf-8'), int(port), ticket.decode('utf-8')))
+                fetch_thread.start()
+                continue
+            elif peer_ticket_pattern.match(message):
+                token, ticket = peer_ticket_pattern.match(message).groups()
+                if peer_server is not None:
+                    peer_server.allow(token.decode('utf-8'),
+                                      ticket.decode('utf-8'))
+                continue
+            elif peer_relay_pattern.match(message):
+                token = peer_relay_pattern.match(message).group(1).decode('utf-8')
+                if peer_server is not None and token in peer_server.files:
+                    relay_thread = threading.Thread(target=chat_room._upload_file_, args=(
+                        peer_server.files[token], token))
+                    relay_thread.start()
+                continue
+            elif peer_relayed_pattern.match(message):
+                token, server_token = peer_relayed_pattern.match(
+                    message).groups()
+                save_path = pending_fetches.pop(token.decode('utf-8'), None)
+                if save_path is not None:
+                    download_thread = threading.Thread(target=chat_room._download_file_, args=(
+                        server_token.decode('utf-8'), save_path))
+                    download_thread.start()
+                continue
+            elif peer_failed_pattern.match(message):
+                token = peer_failed_pattern.match(message).group(1)
+                if pending_fetches.pop(token.decode('utf-8'), None) is not None:
+                    chat_room.ui.textBrowser.append(
+                        "---- The file could not be fetched, the owner is not available\n")
+                continue
+            elif remove_file_pattern.match(message):
+                token = remove_file_pattern.match(message).group(1)
+                chat_room.remove_file_list(token)
                 continue
             elif null_pattern.match(message):
                 continue
@@ -611,6 +1072,8 @@ def receive() -> None:
                 continue
             chat_room.ui.textBrowser.append(raw_message)
         except:
+            if session_token and not leaving and reconnect():
+                continue
             chat_room.ui.textBrowser.append(
                 "                           ------   Cannot connect to the server!   ------                           \n")
             chat_room.ui.pushButton.setEnabled(False)
@@ -618,21 +1081,69 @@ def receive() -> None:
 
 
 # ------------------------------------------------------Global Variables-------------------------------------------------------
-chat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+FRAME_SIZE = 1024
+TRANSFER_CHUNK = 64 * 1024
+# bytes of the BLAKE2b digest that protects every transfer
+DIGEST_SIZE = 32
+# rolling Adler-32 checksum and strong BLAKE2b hash of one block
+SIGNATURE = struct.Struct('!I16s')
+# delta instruction: b'B' + block index, b'L' + literal length, b'E' + 0
+DELTA_HEADER = struct.Struct('!cI')
+# windows a delta rolls byte by byte after a miss, two find the next
+# block after an insertion of up to a block
+DELTA_ROLL = 2
+# most blocks probed one by one before a delta rolls byte by byte again
+DELTA_STRIDE = 16
+# tries to resume the session after the connection drops
+RECONNECT_ATTEMPTS = 10
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 8
+# seconds to wait for a peer in P2P transfers
+PEER_TIMEOUT = 10
+# listeners of the file transfers, the chat port is the one entered
+TRANSFER_PORTS = {b'upload': 8080, b'download': 9000}
+# chat and transfers as streams of one connection
+MULTIPLEX = '--mux' in sys.argv
+multiplexer = None
+chat_socket = None
 server_host = None
+server_port = None
+session_token = None
+received_frames = 0
+leaving = False
 app = QApplication(sys.argv)
 login = ConnectFormGUI()
 name_gui = NameFormGUI()
 chat_room = ChatRoomGUI()
 online_users = set()
 user_name = b""
+p2p_mode = False
+peer_server = None
+# token: save path of files requested from their owner
+pending_fetches = dict()
 update_pattern = re.compile(rb'\x00+UPDATE \((.+)\)\x00*')
 remove_pattern = re.compile(rb'\x00+REMOVE \((.+)\)\x00*')
-new_file_pattern = re.compile(rb'\x00+UPDATE_FILE \((.+)\) \((.+)\)\x00*')
+new_file_pattern = re.compile(
+    rb'\x00+UPDATE_FILE \((.+)\) \((\w+)\) \((\w+)\)\x00*')
+remove_file_pattern = re.compile(rb'\x00+REMOVE_FILE \((\w+)\)\x00*')
+new_peer_file_pattern = re.compile(
+    rb'\x00+UPDATE_PEER_FILE \((.+)\) \((\w+)\)\x00*')
+peer_pattern = re.compile(
+    rb'\x00+PEER \((\w+)\) \(([\w.:-]+)\) \((\d+)\) \((\w+)\)\x00*')
+peer_ticket_pattern = re.compile(rb'\x00+PEER_TICKET \((\w+)\) \((\w+)\)\x00*')
+peer_relay_pattern = re.compile(rb'\x00+PEER_RELAY \((\w+)\)\x00*')
+peer_relayed_pattern = re.compile(
+    rb'\x00+PEER_RELAYED \((\w+)\) \((\w+)\)\x00*')
+peer_failed_pattern = re.compile(rb'\x00+PEER_FAILED \((\w+)\)\x00*')
+peer_header_pattern = re.compile(r'^\((.+)\) \((\d+)\)$')
+signature_header_pattern = re.compile(r'^\((\d+)\) \((\d+)\)$')
+download_header_pattern = re.compile(r'^\((.+)\) \((\d+)\) \((\w+)\)$')
 null_pattern = re.compile(rb'\x00+')
+session_pattern = re.compile(r'^\x00SESSION \((\w+)\)$')
+queued_pattern = re.compile(r'^\x00QUEUED \((\d+)\)$')
 null_text_pattern = re.compile(r'^\[.*?\]:[\s\x00]+$')
 # ----------------------------------------------------------Main----------------------------------------------------------
 if __name__ == "__main__":
     login.show()
-    app.aboutToQuit.connect(lambda: chat_socket.close())
+    app.aboutToQuit.connect(leave_room)
     sys.exit(app.exec())
@@ -0,0 +1,263 @@
+import threading
+import socket
+import struct
+from collections import deque
+
+# multiplexed transport: the chat and any number of file transfers share
+# one TCP connection to the chat port as logical streams
+# the client starts the connection with MUX_MAGIC, after that every
+# frame is MUX_HEADER (kind, stream, length) followed by its payload
+MUX_MAGIC = b'\x00MUX\x00'
+MUX_HEADER = struct.Struct('!BIH')
+# OPEN carries the channel (chat, upload or download) of a new stream,
+# WINDOW hands the sender more credit, CLOSE ends a stream
+OPEN, DATA, WINDOW, CLOSE = 1, 2, 3, 4
+WINDOW_UPDATE = struct.Struct('!I')
+# largest DATA payload, a control frame never waits for more than one
+# bulk frame to go out
+MUX_CHUNK = 16 * 1024
+# bytes a stream may have in flight before the receiver grants more
+MUX_WINDOW = 256 * 1024
+# seconds a closing connection waits for its queued frames to go out
+MUX_CLOSE_TIMEOUT = 2
+# streams whose data goes out ahead of bulk transfer data
+URGENT_CHANNELS = {b'chat'}
+
+
+class Stream:
+    # one logical connection, it offers the socket methods the chat and
+    # transfer code uses so that code runs unchanged on top of it
+
+    def __init__(self, multiplexer, number, channel) -> None:
+        self.multiplexer = multiplexer
+        self.number = number
+        self.channel = channel
+        self.urgent = channel in URGENT_CHANNELS
+        self.condition = threading.Condition()
+        self.buffer = bytearray()
+        # bytes this side may still send, and bytes read since the
+        # last window update
+        self.credit = MUX_WINDOW
+        self.consumed = 0
+        # nothing more to read, nothing more to write, CLOSE went out
+        self.eof = False
+        self.closed = False
+        self.finished = False
+        self.timeout = None
+
+    def feed(self, data) -> None:
+        with self.condition:
+            self.buffer += data
+            self.condition.notify_all()
+
+    def grant(self, amount) -> None:
+        with self.condition:
+            self.credit += amount
+            self.condition.notify_all()
+
+    def end(self) -> None:
+        # the other side closed the stream or the connection is gone,
+        # what is buffered can still be read
+        with self.condition:
+            self.eof = self.closed = self.finished = True
+            self.condition.notify_all()
+
+    def recv(self, size) -> bytes:
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.buffer or self.eof,
+                                           self.timeout):
+                raise socket.timeout('timed out')
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            self.consumed += len(data)
+            grant = 0
+            if self.consumed >= MUX_WINDOW // 2 and not self.eof:
+                grant, self.consumed = self.consumed, 0
+        if grant:
+            self.multiplexer.send(
+                WINDOW, self.number, WINDOW_UPDATE.pack(grant), True)
+        return data
+
+    def sendall(self, data) -> None:
+        view = memoryview(data)
+        while view:
+            with self.condition:
+                self.condition.wait_for(lambda: self.credit > 0 or self.closed)
+                if self.closed:
+                    raise BrokenPipeError('stream closed')
+                size = min(len(view), self.credit, MUX_CHUNK)
+                self.credit -= size
+            self.multiplexer.send(
+                DATA, self.number, bytes(view[:size]), self.urgent)
+            view = view[size:]
+
+    def send(self, data) -> int:
+        self.sendall(data)
+        return len(data)
+
+    def setsockopt(self, *arguments) -> None:
+        # options belong to the shared connection
+        pass
+
+    def settimeout(self, timeout) -> None:
+        self.timeout = timeout
+
+    def shutdown(self, how=socket.SHUT_RDWR) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # CLOSE follows the data of the stream in the same queue,
+        # so it never overtakes it
+        with self.condition:
+            self.eof = self.closed = True
+            self.condition.notify_all()
+            if self.finished:
+                return
+            self.finished = True
+        try:
+            self.multiplexer.send(CLOSE, self.number, b'', self.urgent)
+        except OSError:
+            pass
+        self.multiplexer.forget(self.number)
+
+
+class Multiplexer:
+    # one TCP connection shared by many streams, a reader thread hands
+    # incoming frames to their streams and a writer thread sends control
+    # frames and chat data ahead of bulk transfer data
+    # on_open(stream, channel) is called for streams the other side opens
+
+    def __init__(self, connection, on_open=None, data=b'') -> None:
+        self.connection = connection
+        self.on_open = on_open
+        # STREAMS[NUMBER] = Stream
+        # {int: Stream}
+        self.streams = dict()
+        self.next_number = 1
+        self.lock = threading.Lock()
+        self.urgent = deque()
+        self.bulk = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.writing = False
+        # bytes read past the magic before the multiplexer took over
+        self.buffer = bytearray(data)
+        threading.Thread(target=self.read, daemon=True).start()
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def open(self, channel) -> Stream:
+        with self.lock:
+            if self.closed:
+                raise ConnectionError('connection closed')
+            number = self.next_number
+            self.next_number += 1
+            stream = Stream(self, number, channel)
+            self.streams[number] = stream
+        self.send(OPEN, number, channel, True)
+        return stream
+
+    def forget(self, number) -> None:
+        with self.lock:
+            self.streams.pop(number, None)
+
+    def send(self, kind, number, payload, urgent) -> None:
+        frame = MUX_HEADER.pack(kind, number, len(payload)) + payload
+        with self.condition:
+            if self.closed:
+                raise BrokenPipeError('connection closed')
+            (self.urgent if urgent else self.bulk).append(frame)
+            self.condition.notify()
+
+    def write(self) -> None:
+        while True:
+            with self.condition:
+                while not self.urgent and not self.bulk and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                # every waiting control and chat frame, then one bulk frame
+                frames = list(self.urgent)
+                self.urgent.clear()
+                if self.bulk:
+                    frames.append(self.bulk.popleft())
+                self.writing = True
+            try:
+                self.connection.sendall(b''.join(frames))
+            except OSError:
+                self.shutdown()
+                return
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def read_exact(self, size) -> bytes:
+        while len(self.buffer) < size:
+            chunk = self.connection.recv(MUX_WINDOW)
+            if not chunk:
+                raise ConnectionError('connection closed')
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read(self) -> None:
+        try:
+            while True:
+                kind, number, length = MUX_HEADER.unpack(
+                    self.read_exact(MUX_HEADER.size))
+                payload = self.read_exact(length)
+                if kind == OPEN:
+                    if self.on_open is None:
+                        continue
+                    stream = Stream(self, number, payload)
+                    with self.lock:
+                        self.streams[number] = stream
+                    self.on_open(stream, payload)
+                    continue
+                stream = self.streams.get(number)
+                if stream is None:
+                    continue
+                if kind == DATA:
+                    stream.feed(payload)
+                    if len(stream.buffer) > MUX_WINDOW:
+                        raise ConnectionError('flow control window exceeded')
+                elif kind == WINDOW:
+                    stream.grant(WINDOW_UPDATE.unpack(payload)[0])
+                elif kind == CLOSE:
+                    stream.end()
+                    self.forget(number)
+        except (OSError, struct.error):
+            pass
+        self.shutdown()
+
+    def close(self, timeout=MUX_CLOSE_TIMEOUT) -> None:
+        # send what is queued, then shut the connection down
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.closed or not (self.urgent or self.bulk or self.writing),
+                timeout)
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        with self.lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream.end()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+def connect(host, port) -> Multiplexer:
+    connection = socket.create_connection((host, port))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connection.sendall(MUX_MAGIC)
+    return Multiplexer(connection)
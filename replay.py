@@ -0,0 +1,604 @@
+import socket
+import threading
+import bisect
+import argparse
+import hashlib
+import struct
+import json
+import time
+import re
+import sys
+
+# replay traffic captured by server.py (CAPTURE_PATH) against a server
+# and measure how fast it is delivered:
+# python replay.py capture.bin --speed 10 --output new.json --compare old.json
+
+FRAME_SIZE = 1024
+DIGEST_SIZE = 32
+TRANSFER_CHUNK = 64 * 1024
+SIGNATURE = struct.Struct('!I16s')
+# (time, connection, event, length) followed by the payload
+CAPTURE_RECORD = struct.Struct('!dIcI')
+# LISTENERS[NAME] = PORT
+# {bytes: int}
+LISTENERS = {b'chat': 9999, b'upload': 8080, b'download': 9000}
+# how long to wait for an answer the recorded client got before moving on
+RESPONSE_TIMEOUT = 10
+# quiet time after the last record before the chat connections are closed
+DRAIN_TIME = 1
+
+token_pattern = re.compile(rb'\(([0-9a-f]{32})\)')
+new_file_pattern = re.compile(
+    rb'\x00+UPDATE_FILE \((.+)\) \((\w+)\) \((\w+)\)\x00*')
+trailer_pattern = re.compile(rb'^\(([0-9a-f]{%d})\)$' % (DIGEST_SIZE * 2))
+sender_pattern = re.compile(rb'^/\w+ \((.{2,16}?)\)')
+delivery_pattern = re.compile(rb'^\[(.{2,16}?)\]: ')
+signature_header_pattern = re.compile(rb'^\((\d+)\) \((\d+)\)$')
+session_pattern = re.compile(rb'^\x00SESSION \((\w+)\)$')
+resume_pattern = re.compile(rb'^\x00RESUME \((\w+)\) \((\d+)\)$')
+download_header_pattern = re.compile(rb'^\((.+)\) \((\d+)\) \((\w+)\)$')
+
+
+def read_capture(path) -> list:
+    # CONNECTIONS = [[LISTENER, [(TIME, EVENT, PAYLOAD)]]] in order of opening
+    connections = dict()
+    with open(path, 'rb') as file:
+        data = file.read()
+    offset = 0
+    while offset + CAPTURE_RECORD.size <= len(data):
+        timestamp, connection, event, length = CAPTURE_RECORD.unpack_from(
+            data, offset)
+        offset += CAPTURE_RECORD.size
+        if offset + length > len(data):
+            # the server stopped in the middle of a record
+            break
+        payload = data[offset:offset + length]
+        offset += length
+        if event == b'o':
+            connections[connection] = [payload, []]
+            continue
+        if event == b'f':
+            # frames are logged without their padding
+            event, payload = b'd', frame(payload)
+        if connection in connections:
+            connections[connection][1].append((timestamp, event, payload))
+    return [connection for connection in connections.values() if connection[1]]
+
+
+def frame(message) -> bytes:
+    return message.ljust(FRAME_SIZE, b'\x00')
+
+
+def recv_exact(client_socket, size) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = client_socket.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def percentile(values, fraction) -> float:
+    return values[int(round(fraction * (len(values) - 1)))] if values else 0.0
+
+
+class Replay:
+    # plays every recorded connection on its own thread, keeping the
+    # recorded gaps divided by speed, records take their turn in the
+    # order they were captured and answers the server gives are waited
+    # for, so a fast replay cannot run ahead of the protocol
+
+    def __init__(self, connections, host, speed) -> None:
+        self.connections = connections
+        self.host = host
+        self.speed = speed
+        self.lock = threading.Condition()
+        # tokens of the capture are different from the ones the server
+        # hands out now, uploads are matched by the digest they were sent with
+        # DIGESTS[RECORDED TOKEN] = DIGEST, TOKENS[DIGEST] = LIVE TOKEN
+        # {bytes: bytes}
+        self.digests = dict()
+        self.tokens = dict()
+        self.recorded_tokens = {payload for _, records in connections
+                                for _, event, payload in records if event == b't'}
+        # SENT[NICKNAME] = [(SEND TIME, FRAME)] in the order it was sent,
+        # a receiver gets the messages of a sender in that order
+        # {bytes: [(float, bytes)]}
+        self.sent = dict()
+        self.latencies = []
+        self.counters = dict.fromkeys(
+            ('messages', 'deliveries', 'undelivered', 'chat_frames', 'bytes_sent',
+             'bytes_received', 'saved', 'damaged', 'refused', 'downloads',
+             'errors'), 0)
+        self.sockets = []
+        self.chats = []
+        # nicknames with a chat session, uploads are only taken from them
+        # {bytes}
+        self.joined = set()
+        # a resume names the session by its recorded token
+        # SESSIONS[RECORDED TOKEN] = ChatConnection
+        # {bytes: ChatConnection}
+        self.sessions = dict()
+        self.last_activity = 0.0
+        self.start = 0.0
+        self.origin = 0.0
+        # number of the record whose turn it is
+        self.turn = 0
+
+    def count(self, counter, amount=1) -> None:
+        with self.lock:
+            self.counters[counter] += amount
+            self.last_activity = time.perf_counter()
+
+    def take_turn(self, number) -> None:
+        with self.lock:
+            self.lock.wait_for(lambda: self.turn == number)
+
+    def pass_turn(self) -> None:
+        with self.lock:
+            self.turn += 1
+            self.lock.notify_all()
+
+    def wait_until(self, timestamp) -> None:
+        delay = self.start + (timestamp - self.origin) / self.speed \
+            - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def remap(self, payload) -> bytes:
+        # swap recorded file tokens for live ones, waiting for the upload
+        # they refer to the way the recorded client did
+        for token in set(token_pattern.findall(payload)):
+            if token not in self.recorded_tokens:
+                continue
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: self.digests.get(token) in self.tokens,
+                    RESPONSE_TIMEOUT)
+                live = self.tokens.get(self.digests.get(token))
+            if live is not None:
+                payload = payload.replace(token, live)
+        return payload
+
+    def run(self) -> dict:
+        # number every record in capture order
+        timeline = sorted((timestamp, index, position)
+                          for index, (_, records) in enumerate(self.connections)
+                          for position, (timestamp, _, _) in enumerate(records))
+        numbered = [[None] * len(records) for _, records in self.connections]
+        for number, (_, index, position) in enumerate(timeline):
+            numbered[index][position] = (number,) + \
+                self.connections[index][1][position]
+        self.origin = timeline[0][0]
+        self.start = self.last_activity = time.perf_counter()
+        threads = []
+        for (listener, _), records in sorted(zip(self.connections, numbered),
+                                             key=lambda connection: connection[1][0][0]):
+            self.wait_until(records[0][1])
+            thread = threading.Thread(
+                target=self.play, args=(listener, records), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        # let the last messages arrive
+        while time.perf_counter() - self.last_activity < DRAIN_TIME:
+            time.sleep(DRAIN_TIME / 10)
+        with self.lock:
+            for chat in self.chats:
+                if not chat.closed and not chat.resumed:
+                    self.counters['undelivered'] += chat.undelivered()
+        for client_socket in self.sockets:
+            client_socket.close()
+        return self.report()
+
+    def play(self, listener, records) -> None:
+        try:
+            client_socket = socket.create_connection(
+                (self.host, LISTENERS[listener]), RESPONSE_TIMEOUT)
+            client_socket.settimeout(None)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            self.count('errors')
+            self.skip(records)
+            return
+        self.sockets.append(client_socket)
+        if listener == b'chat':
+            connection = ChatConnection(self, client_socket)
+            self.chats.append(connection)
+        elif listener == b'upload':
+            connection = UploadConnection(self, client_socket)
+        else:
+            connection = DownloadConnection(self, client_socket)
+        reader = threading.Thread(target=connection.read, daemon=True)
+        reader.start()
+        for position, (number, timestamp, event, payload) in enumerate(records):
+            self.wait_until(timestamp)
+            self.take_turn(number)
+            if event == b'c':
+                self.pass_turn()
+                connection.close(reader)
+                return
+            if event == b'z':
+                # bulk content does not hold up the other connections
+                self.pass_turn()
+            try:
+                connection.send(event, payload)
+            except OSError:
+                self.count('errors')
+                if event != b'z':
+                    self.pass_turn()
+                self.skip(records[position + 1:])
+                connection.close(reader)
+                return
+            if event != b'z':
+                self.pass_turn()
+        # still connected when the capture ended, closed after the drain
+
+    def skip(self, records) -> None:
+        # a connection that failed still lets the others have their turn
+        for number, _, _, _ in records:
+            self.take_turn(number)
+            self.pass_turn()
+
+    def report(self) -> dict:
+        duration = max(self.last_activity - self.start, 1e-9)
+        latencies = sorted(self.latencies)
+        counters = self.counters
+        return {
+            'duration': round(duration, 3),
+            'connections': len(self.connections),
+            'messages': counters['messages'],
+            'deliveries': counters['deliveries'],
+            'undelivered': counters['undelivered'],
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+            'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'latency_max_ms': round(latencies[-1] * 1000 if latencies else 0, 3),
+            'chat_frames_per_second': round(counters['chat_frames'] / duration, 1),
+            'transfer_bytes_per_second': round(
+                (counters['bytes_sent'] + counters['bytes_received']) / duration),
+            'uploads_saved': counters['saved'],
+            'uploads_damaged': counters['damaged'],
+            'uploads_refused': counters['refused'],
+            'downloads': counters['downloads'],
+            'errors': counters['errors'],
+        }
+
+
+class ChatConnection:
+
+    def __init__(self, replay, client_socket) -> None:
+        self.replay = replay
+        self.socket = client_socket
+        self.nickname = b''
+        self.joined = False
+        self.answered = threading.Event()
+        self.finished = threading.Event()
+        # live session token and frames received, for a resume
+        self.token = None
+        self.received = 0
+        # the session went on over another connection
+        self.resumed = False
+        self.closed = False
+        # LIMITS[SENDER] = messages of the sender sent when this client
+        # began to leave, the ones it still has to receive
+        # {bytes: int}
+        self.limits = None
+        # messages sent before this client asked to join never reach it
+        self.started = None
+        # POSITIONS[SENDER] = next message of the sender it can receive
+        # {bytes: int}
+        self.positions = dict()
+
+    def send(self, event, payload) -> None:
+        replay = self.replay
+        if event == b'n':
+            # the nickname is read raw, wait for the answer before the
+            # first frame so both do not arrive in one read
+            if self.joined:
+                return
+            resume = resume_pattern.match(payload)
+            if resume:
+                payload = self.resume(resume.group(1)) or payload
+            else:
+                self.nickname = payload
+            if self.started is None:
+                self.started = time.perf_counter()
+            self.answered.clear()
+            self.socket.sendall(payload)
+            self.answered.wait(RESPONSE_TIMEOUT)
+            return
+        if event == b's':
+            with replay.lock:
+                replay.sessions[payload] = self
+            return
+        if event != b'd':
+            return
+        payload = replay.remap(payload)
+        message = payload.rstrip(b'\x00')
+        if message == b'\x00LEAVE':
+            # the server drops the session at once, no delivery after it
+            self.settle()
+        if message and not message.startswith((b'/', b'\x00')):
+            key = b'[' + self.nickname + b']: ' + message
+            with replay.lock:
+                replay.sent.setdefault(self.nickname, []).append(
+                    (time.perf_counter(), key))
+                replay.counters['messages'] += 1
+        self.socket.sendall(payload)
+
+    def resume(self, recorded) -> bytes:
+        # pick up the replayed session the recorded token stands for,
+        # None if it never started here
+        replay = self.replay
+        with replay.lock:
+            previous = replay.sessions.get(recorded)
+            replay.sessions[recorded] = self
+        if previous is None or previous.token is None:
+            return None
+        # the recorded connection was gone by now, make sure ours is too
+        # so the count of frames it got is final
+        previous.resumed = True
+        try:
+            previous.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        previous.finished.wait(RESPONSE_TIMEOUT)
+        self.nickname = previous.nickname
+        self.started = previous.started
+        self.positions = previous.positions
+        self.token = previous.token
+        self.received = previous.received
+        return b'\x00RESUME (' + self.token + b') (' + \
+            str(self.received).encode('utf-8') + b')'
+
+    def read(self) -> None:
+        replay = self.replay
+        try:
+            while True:
+                message = recv_exact(self.socket, FRAME_SIZE).rstrip(b'\x00')
+                arrived = time.perf_counter()
+                self.received += 1
+                self.answered.set()
+                with replay.lock:
+                    replay.counters['chat_frames'] += 1
+                    replay.last_activity = arrived
+                    delivery = delivery_pattern.match(message)
+                    if delivery and delivery.group(1) in replay.sent:
+                        self.deliver(delivery.group(1), message, arrived)
+                        replay.lock.notify_all()
+                    new_file = new_file_pattern.match(message)
+                    if new_file:
+                        replay.tokens[new_file.group(3)] = new_file.group(2)
+                        replay.lock.notify_all()
+                session = session_pattern.match(message)
+                if session or message == b'\x00RESUMED':
+                    self.joined = True
+                    if session:
+                        self.token = session.group(1)
+                    with replay.lock:
+                        replay.joined.add(self.nickname)
+                        replay.lock.notify_all()
+        except OSError:
+            self.answered.set()
+            self.finished.set()
+            with replay.lock:
+                replay.lock.notify_all()
+
+    def deliver(self, sender, message, arrived) -> None:
+        # match a message with its send, the first one of the sender
+        # after this client joined that was not delivered yet, messages
+        # the server dropped are skipped, the caller holds the lock
+        sent = self.replay.sent[sender]
+        position = self.positions.get(sender)
+        if position is None:
+            position = bisect.bisect_left(sent, (self.started,))
+        while position < len(sent) and sent[position][1] != message:
+            position += 1
+        if position == len(sent):
+            return
+        self.positions[sender] = position + 1
+        self.replay.latencies.append(arrived - sent[position][0])
+        self.replay.counters['deliveries'] += 1
+
+    def undelivered(self) -> int:
+        # messages of the others this client should still receive,
+        # the caller holds the lock
+        if self.started is None:
+            return 0
+        limits = self.limits or {sender: len(sent)
+                                 for sender, sent in self.replay.sent.items()}
+        missing = 0
+        for sender, limit in limits.items():
+            if sender == self.nickname:
+                continue
+            position = self.positions.get(sender)
+            if position is None:
+                position = bisect.bisect_left(
+                    self.replay.sent[sender], (self.started,))
+            missing += max(0, limit - position)
+        return missing
+
+    def settle(self) -> None:
+        # before leaving, wait for the messages sent so far to arrive, a
+        # server that holds senders back would otherwise lose them
+        replay = self.replay
+        with replay.lock:
+            if self.limits is None:
+                self.limits = {sender: len(sent)
+                               for sender, sent in replay.sent.items()}
+            replay.lock.wait_for(
+                lambda: self.finished.is_set() or not self.undelivered(),
+                RESPONSE_TIMEOUT)
+
+    def close(self, reader) -> None:
+        # the recorded client left, the room is told right away
+        if not self.resumed:
+            self.settle()
+            with self.replay.lock:
+                self.closed = True
+                self.replay.counters['undelivered'] += self.undelivered()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class UploadConnection:
+
+    def __init__(self, replay, client_socket) -> None:
+        self.replay = replay
+        self.socket = client_socket
+        self.ready = threading.Event()
+        self.refused = False
+        self.metadata_sent = False
+        # content recorded as a length only is replaced by zeros, the
+        # digest trailer after it is recomputed to match, except for a
+        # delta upload whose blocks of the base cannot be reproduced, the
+        # server does the same work and reports it damaged
+        self.filler = None
+        self.digest = b''
+
+    def send(self, event, payload) -> None:
+        replay = self.replay
+        if event == b't':
+            with replay.lock:
+                replay.digests[payload] = self.digest
+                replay.lock.notify_all()
+            return
+        if event == b'z':
+            if self.filler is None:
+                self.filler = hashlib.blake2b(digest_size=DIGEST_SIZE)
+            size, = struct.unpack('!I', payload)
+            data = bytes(size)
+            self.filler.update(data)
+            self.socket.sendall(data)
+            replay.count('bytes_sent', size)
+            return
+        if event != b'd':
+            return
+        if not self.metadata_sent:
+            # /upload, /relay or /delta, the server answers READY once
+            # there is room and a transfer slot
+            self.metadata_sent = True
+            sender = sender_pattern.match(payload)
+            if sender:
+                with replay.lock:
+                    replay.lock.wait_for(
+                        lambda: sender.group(1) in replay.joined, RESPONSE_TIMEOUT)
+            self.socket.sendall(replay.remap(payload))
+            self.ready.wait(RESPONSE_TIMEOUT)
+            if self.refused:
+                raise ConnectionError('upload refused')
+            return
+        trailer = trailer_pattern.match(payload.rstrip(b'\x00'))
+        if trailer and len(payload) == FRAME_SIZE:
+            if self.filler is not None:
+                payload = frame(
+                    b'(' + self.filler.hexdigest().encode('utf-8') + b')')
+            self.digest = payload.rstrip(b'\x00')[1:-1]
+        self.socket.sendall(payload)
+        replay.count('bytes_sent', len(payload))
+
+    def read(self) -> None:
+        replay = self.replay
+        try:
+            while True:
+                message = recv_exact(self.socket, FRAME_SIZE).rstrip(b'\x00')
+                signatures = signature_header_pattern.match(message)
+                if signatures:
+                    recv_exact(self.socket,
+                               int(signatures.group(2)) * SIGNATURE.size)
+                elif message == b'READY':
+                    self.ready.set()
+                elif message in (b'RATE_LIMITED', b'QUOTA_EXCEEDED'):
+                    self.refused = True
+                    replay.count('refused')
+                    self.ready.set()
+                elif message == b'SAVED':
+                    replay.count('saved')
+                elif message == b'DAMAGED':
+                    replay.count('damaged')
+        except OSError:
+            self.refused = self.refused or not self.ready.is_set()
+            self.ready.set()
+
+    def close(self, reader) -> None:
+        # the server ends transfers, give it the time the recording took
+        reader.join(RESPONSE_TIMEOUT)
+        self.socket.close()
+
+
+class DownloadConnection:
+
+    def __init__(self, replay, client_socket) -> None:
+        self.replay = replay
+        self.socket = client_socket
+
+    def send(self, event, payload) -> None:
+        if event == b'd':
+            self.socket.sendall(self.replay.remap(payload))
+
+    def read(self) -> None:
+        replay = self.replay
+        try:
+            while True:
+                message = recv_exact(self.socket, FRAME_SIZE).rstrip(b'\x00')
+                header = download_header_pattern.match(message)
+                if header:
+                    break
+            size = int(header.group(2))
+            received = 0
+            while received < size:
+                data = self.socket.recv(min(TRANSFER_CHUNK, size - received))
+                if not data:
+                    break
+                received += len(data)
+                replay.count('bytes_received', len(data))
+            if received == size:
+                replay.count('downloads')
+        except OSError:
+            return
+
+    def close(self, reader) -> None:
+        reader.join(RESPONSE_TIMEOUT)
+        self.socket.close()
+
+
+def compare(baseline, results) -> None:
+    print(f'{"":28}{"baseline":>14}{"this run":>14}{"change":>10}')
+    for key, value in results.items():
+        old = baseline.get(key)
+        change = f'{(value - old) / old * 100:+.1f}%' if old else ''
+        print(f'{key:28}{str(old):>14}{str(value):>14}{change:>10}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay traffic captured by server.py')
+    parser.add_argument('capture', help='file written with CAPTURE_PATH')
+    parser.add_argument('--host', default=socket.gethostname())
+    parser.add_argument('--speed', default='1',
+                        help='1 for real time, N for N times faster, max for no waiting')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='results of an earlier run')
+    arguments = parser.parse_args()
+
+    speed = float('inf') if arguments.speed == 'max' else float(arguments.speed)
+    if speed <= 0:
+        sys.exit('--speed must be positive or max')
+    connections = read_capture(arguments.capture)
+    if not connections:
+        sys.exit('nothing to replay')
+    results = Replay(connections, arguments.host, speed).run()
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            compare(json.load(file), results)
+    else:
+        for key, value in results.items():
+            print(f'{key:28}{value}')
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=4)
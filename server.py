@@ -6,14 +6,155 @@ import re
 import sys
 import os
 import uuid
-# CLIENT[NICKNAME] = [SOCKET, ADDRESS]
-# {bytes: [socket.socket, (str, int)]}
+import tempfile
+import ipaddress
+import hashlib
+import struct
+import zlib
+import time
+import math
+import unicodedata
+import bisect
+import heapq
+from array import array
+from collections import OrderedDict, deque
+import mux
+# CLIENT[NICKNAME] = Session
+# {bytes: Session}
 CLIENTS = SortedDict()
 
-# FILES[TOKEN] = (filename,file_server_path,owner)
-# {str: (bytes,str,bytes)}
+# FILES[TOKEN] = (filename,file_server_path,owner,size,digest)
+# {str: (bytes,str,bytes,int,str)}
 FILES = dict()
-LOCATION = uuid.uuid4().hex
+# uploads are stored outside the source tree, one directory per server run
+LOCATION = os.path.join(tempfile.gettempdir(), uuid.uuid4().hex)
+
+# block signatures of stored files, kept for delta uploads of new versions
+# SIGNATURES[TOKEN] = SIGNATURE packed once per BLOCK_SIZE block
+# {str: bytes}
+SIGNATURES = dict()
+
+# files shared in P2P mode stay on the owner's machine, the server only
+# tells recipients where to fetch them from
+# PEER_FILES[TOKEN] = (filename,owner,size,port)
+# {str: (bytes,bytes,int,int)}
+PEER_FILES = dict()
+# copies uploaded to the server for recipients that cannot reach the owner
+# RELAYED[PEER_TOKEN] = TOKEN
+# {str: str}
+RELAYED = dict()
+# RELAY_WAITING[PEER_TOKEN] = {NICKNAME}
+# {str: {bytes}}
+RELAY_WAITING = dict()
+# direct transfers are only brokered between clients of the same subnet
+P2P_PREFIX = 24
+
+# WRITERS[SOCKET] = ConnectionWriter
+# {socket.socket: ConnectionWriter}
+WRITERS = dict()
+
+# resumable chat sessions, a client that lost its connection may pick up
+# where it left off within RESUME_GRACE seconds
+# SESSIONS[SESSION_TOKEN] = NICKNAME
+# {str: bytes}
+SESSIONS = dict()
+# sessions waiting for their client to come back
+# DETACHED[NICKNAME] = ConnectionWriter
+# {bytes: ConnectionWriter}
+DETACHED = dict()
+SESSION_LOCK = threading.Lock()
+RESUME_GRACE = 30
+# frames kept per session for replay after a reconnect
+REPLAY_BUFFER = 256
+
+# every chat message travels in fixed-size frames padded with null bytes
+FRAME_SIZE = 1024
+# upper bound of buffers passed to a single sendmsg call
+IOV_MAX = 1024
+# frames queued for a client that stopped reading before it is cut off
+WRITER_QUEUE_LIMIT = 4096
+
+# RATE_LIMITS[KIND] = [RATE, BURST, ACTION]
+# {str: [float, float, str]}
+# token bucket limits per chat connection, RATE is refilled every second,
+# BURST is the bucket size and ACTION is what happens to excess traffic:
+# 'delay' holds the client back, 'drop' discards it with a notice and
+# 'disconnect' kicks the client, a RATE of 0 disables the limit
+RATE_LIMITS = {
+    'messages': [5, 20, 'delay'],
+    'bytes': [16384, 65536, 'delay'],
+    'private': [2, 10, 'drop'],
+    'uploads': [0.2, 3, 'drop'],
+}
+RATE_ACTIONS = ('delay', 'drop', 'disconnect')
+
+# file transfers running at the same time, in total and per user
+MAX_TRANSFERS = 8
+MAX_USER_TRANSFERS = 2
+# bytes per second shared by all running transfers, 0 means unlimited
+TRANSFER_BANDWIDTH = 32 * 1024 * 1024
+# share of the bandwidth each kind of transfer gets relative to the others
+TRANSFER_WEIGHTS = {'upload': 1, 'download': 2}
+TRANSFER_CHUNK = 64 * 1024
+# bytes of the BLAKE2b digest that protects every transfer
+DIGEST_SIZE = 32
+# delta uploads reuse unchanged blocks of this size from an earlier version
+BLOCK_SIZE = 16 * 1024
+# rolling Adler-32 checksum and strong BLAKE2b hash of one block
+SIGNATURE = struct.Struct('!I16s')
+# delta instruction: b'B' + block index, b'L' + literal length, b'E' + 0
+DELTA_HEADER = struct.Struct('!cI')
+# longest time a transfer steps aside for queued chat frames
+CHAT_PRIORITY_WAIT = 0.05
+
+# bytes the upload store may hold, in total and per user, 0 means unlimited
+STORE_QUOTA = 4 * 1024 ** 3
+STORE_USER_QUOTA = 1024 ** 3
+# how room is made for a new upload when a quota is reached:
+# 'lru' removes the least recently used files, 'size' the largest files
+# and None refuses the upload
+EVICTION_POLICY = 'lru'
+# seconds after which an uploaded file is removed, 0 keeps files forever
+FILE_TTL = 24 * 60 * 60
+# seconds between two looks for expired files
+EXPIRE_INTERVAL = 60
+
+# full-text search over public messages and file names
+# results shown per /search page
+SEARCH_PAGE = 10
+# newest matches ranked per query, the search stops looking after that
+SEARCH_CANDIDATES = 2000
+# append-only file the index is rebuilt from on start, None keeps it in memory
+SEARCH_INDEX_PATH = None
+# RECORD = (timestamp, kind, author length, text length) + author + text
+SEARCH_RECORD = struct.Struct('!dcHI')
+
+# traffic capture for replay.py, None turns it off
+# every record is (time, connection, event, length) followed by the payload
+# 'o' connection opened, payload is the listener: chat, upload or download
+# 'n' raw handshake read (nickname or resume request)
+# 's' the chat session was issued the token in the payload
+# 'f' frame read from the connection, without its null padding
+# 'd' other data read from the connection
+# 'z' length of uploaded file content, the content itself is only
+#     kept (as 'd') with CAPTURE_FILE_DATA
+# 't' the upload was stored under the token in the payload
+# 'c' connection closed
+CAPTURE_PATH = None
+CAPTURE_FILE_DATA = False
+CAPTURE_RECORD = struct.Struct('!dIcI')
+
+# chat writers with frames waiting for their writer thread, a writer
+# blocked in a send is not counted, transfers could not help it along
+# {ConnectionWriter}
+BUSY_WRITERS = set()
+
+# every chat connection runs two threads (handle and writer) that sit idle
+# most of the time, a smaller stack keeps their reserved memory down
+THREAD_STACK_SIZE = 512 * 1024
+threading.stack_size(THREAD_STACK_SIZE)
+# sessions listed by /memory
+MEMORY_REPORT = 10
 
 # create sockets for different purposes
 chat_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -28,20 +169,12 @@ CHAT_PORT = 9999
 FILE_UPLOAD_PORT = 8080
 FILE_DOWNLOAD_PORT = 9000
 
+# clients may also run the chat and their transfers as streams of one
+# connection to CHAT_PORT (see mux.py), False turns that off
+MULTIPLEX = True
 
-# allow only one instance of the chat_server to run
-try:
-    chat_server.bind((CHAT_HOST, CHAT_PORT))
-    file_upload_server.bind((FILE_UPLOAD_HOST, FILE_UPLOAD_PORT))
-    file_download_server.bind((FILE_DOWNLOAD_HOST, FILE_DOWNLOAD_PORT))
-except:
-    ctypes.windll.user32.MessageBoxW(
-        0, "Another instance of the server is already running!", "Error", 1)
-    sys.exit(0)
-# listen for clients
-chat_server.listen()
-file_upload_server.listen()
-file_download_server.listen()
+# clients connecting from the server machine may use admin commands
+ADMIN_HOSTS = {'127.0.0.1', socket.gethostbyname(CHAT_HOST)}
 
 
 def private_message(client_socket, nickname, message) -> None:
@@ -52,29 +185,824 @@ def private_message(client_socket, nickname, message) -> None:
         send_to_client(
             client_socket, '————> User not found. Please try again.')
         return
-    send_to_client(CLIENTS[lookup_nickname][0],
+    send_to_client(CLIENTS[lookup_nickname].socket,
                    f'[Private from {nickname.decode("utf-8")}]: {text}')
 
 
-def send_to_client(client_socket, message) -> None:
-    # padding to make each message 1024 bytes
-    # if message is larger than 1024 bytes, then store the rest in a list
-    # and send the list to the client
-    # message in string format
-    # format each message to be 1024 bytes
+def frame_message(message) -> list:
+    # split the message into FRAME_SIZE-byte frames and pad the last one
+    # a multi-byte character is never split across two frames, so every
+    # frame can be decoded on its own by the client
     # reference: https://stackoverflow.com/questions/39479036/python-make-sure-to-send-1024-bytes-at-a-time
-    if len(message) < 1024:
-        message = message + (1024-len(message))*'\x00'
-        client_socket.send(message.encode('utf-8'))
+    data = message.encode('utf-8')
+    frames = []
+    while len(data) > FRAME_SIZE:
+        cut = FRAME_SIZE
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        frames.append(data[:cut].ljust(FRAME_SIZE, b'\x00'))
+        data = data[cut:]
+    frames.append(data.ljust(FRAME_SIZE, b'\x00'))
+    return frames
+
+
+def recv_exact(client_socket, size, event=b'd') -> bytes:
+    # the stream may deliver the data in several pieces
+    # event None leaves the capture to the caller
+    data = bytearray()
+    while len(data) < size:
+        chunk = client_socket.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    if event is not None:
+        capture(client_socket, event,
+                data.rstrip(b'\x00') if event == b'f' else data)
+    return bytes(data)
+
+
+def recv_frame(client_socket) -> bytes:
+    # read exactly one frame
+    return recv_exact(client_socket, FRAME_SIZE, b'f')
+
+
+def send_frames(client_socket, frames) -> None:
+    # gather all frames into one vectored send
+    # sendmsg is not available on Windows, join the frames there instead
+    if not hasattr(client_socket, 'sendmsg'):
+        client_socket.sendall(b''.join(frames))
+        return
+    frames = [memoryview(frame) for frame in frames]
+    index = 0
+    while index < len(frames):
+        sent = client_socket.sendmsg(frames[index:index + IOV_MAX])
+        # skip the frames that went out completely
+        # and keep the rest of a partially sent one
+        while index < len(frames) and sent >= len(frames[index]):
+            sent -= len(frames[index])
+            index += 1
+        if sent:
+            frames[index] = frames[index][sent:]
+
+
+class ConnectionWriter:
+    # outgoing queue of one chat session
+    # every frame queued while the writer thread is busy goes out
+    # together in the next send, so a burst of notifications costs
+    # one system call instead of one per frame
+    # frames are numbered from 1 in the order they are written and the
+    # last REPLAY_BUFFER of them are kept for a client that reconnects
+    __slots__ = ('client_socket', 'pending', 'closed', 'sequence', 'replay',
+                 'sending', 'condition', 'thread')
+
+    def __init__(self, client_socket) -> None:
+        self.client_socket = client_socket
+        self.pending = []
+        self.closed = False
+        self.sequence = 0
+        self.replay = deque(maxlen=REPLAY_BUFFER)
+        self.sending = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, frames) -> None:
+        with self.condition:
+            if self.closed:
+                return
+            self.sequence += len(frames)
+            self.replay.extend(frames)
+            # a detached session only keeps the frames for replay
+            if self.client_socket is None:
+                return
+            self.pending.extend(frames)
+            if len(self.pending) > WRITER_QUEUE_LIMIT:
+                # the client does not keep up, drop the connection instead
+                # of holding everything sent to it, the handle thread
+                # detaches the session
+                self.pending = []
+                shutdown_socket(self.client_socket)
+                return
+            if not self.sending:
+                BUSY_WRITERS.add(self)
+            self.condition.notify()
+
+    def detach(self) -> None:
+        # the connection is gone, keep numbering frames until it comes back
+        with self.condition:
+            self.client_socket = None
+            self.pending = []
+            BUSY_WRITERS.discard(self)
+
+    def attach(self, client_socket, received, greeting) -> bool:
+        # continue on a new connection with the frames after the last one
+        # the client received, False if they are no longer buffered
+        with self.condition:
+            missed = self.sequence - received
+            if self.closed or missed < 0 or missed > len(self.replay):
+                return False
+            self.client_socket = client_socket
+            self.pending = greeting + list(self.replay)[len(self.replay) - missed:]
+            if not self.sending:
+                BUSY_WRITERS.add(self)
+            self.condition.notify()
+            return True
+
+    def close(self, flush=False) -> None:
+        # stop the writer, with flush the queued frames are sent first
+        with self.condition:
+            self.closed = True
+            if not flush:
+                self.pending = []
+                BUSY_WRITERS.discard(self)
+            self.condition.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                frames, self.pending = self.pending, []
+                closed = self.closed
+                client_socket = self.client_socket
+                # the frames are on their way, transfers go on meanwhile
+                BUSY_WRITERS.discard(self)
+                self.sending = True
+            try:
+                if frames and client_socket is not None:
+                    send_frames(client_socket, frames)
+            except OSError:
+                # the handle thread detaches the session
+                shutdown_socket(client_socket)
+            with self.condition:
+                self.sending = False
+            if closed:
+                if client_socket is not None:
+                    shutdown_socket(client_socket)
+                    client_socket.close()
+                return
+
+
+def shutdown_socket(client_socket) -> None:
+    # shutdown wakes up the handle thread blocked in recv
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def send_to_client(client_socket, message) -> None:
+    send_frames_to_client(client_socket, frame_message(message))
+
+
+def send_frames_to_client(client_socket, frames) -> None:
+    # chat connections go through their writer, other sockets
+    # (file transfers) are written directly
+    writer = WRITERS.get(client_socket)
+    if writer is None:
+        send_frames(client_socket, frames)
+    else:
+        writer.write(frames)
+
+
+class TrafficCapture:
+    # timestamped log of everything clients send, per connection
+
+    def __init__(self, path) -> None:
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        # IDS[SOCKET] = CONNECTION
+        # {socket.socket: int}
+        self.ids = dict()
+        self.next_id = 0
+
+    def open(self, client_socket, listener) -> None:
+        with self.lock:
+            self.next_id += 1
+            self.ids[client_socket] = self.next_id
+            self.write(self.next_id, b'o', listener)
+
+    def record(self, client_socket, event, payload) -> None:
+        with self.lock:
+            connection = self.ids.get(client_socket)
+            if connection is None:
+                return
+            self.write(connection, event, payload)
+            if event == b'c':
+                del self.ids[client_socket]
+                self.file.flush()
+
+    def write(self, connection, event, payload) -> None:
+        self.file.write(CAPTURE_RECORD.pack(
+            time.time(), connection, event, len(payload)))
+        self.file.write(payload)
+
+
+CAPTURE = TrafficCapture(CAPTURE_PATH) if CAPTURE_PATH else None
+
+
+def capture(client_socket, event, payload=b'') -> None:
+    if CAPTURE is not None:
+        CAPTURE.record(client_socket, event, payload)
+
+
+def capture_open(client_socket, listener) -> None:
+    if CAPTURE is not None:
+        CAPTURE.open(client_socket, listener)
+
+
+def capture_file_data(client_socket, data) -> None:
+    # uploaded content is only kept with CAPTURE_FILE_DATA, its length always
+    if CAPTURE_FILE_DATA:
+        capture(client_socket, b'd', data)
     else:
-        message_list = []
-        while len(message) > 1024:
-            message_list.append(message[:1024])
-            message = message[1024:]
-        if len(message):
-            message_list.append(message + (1024-len(message))*'\x00')
-        for message in message_list:
-            client_socket.send(message.encode('utf-8'))
+        capture(client_socket, b'z', struct.pack('!I', len(data)))
+
+
+def notify_all(message) -> None:
+    # one set of frames is shared by the queues of all clients
+    frames = frame_message(message)
+    for session in CLIENTS.values():
+        send_frames_to_client(session.socket, frames)
+
+
+class TokenBucket:
+    # holds up to burst tokens and refills rate tokens per second
+    # rate and burst may be changed at any time
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount=1) -> float:
+        # take amount tokens and return 0
+        # or return the seconds to wait until they are available
+        with self.lock:
+            if self.rate <= 0:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.stamp) * self.rate)
+            self.stamp = now
+            # a request larger than the bucket passes once it is full
+            amount = min(amount, self.burst)
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+
+def create_limiters() -> dict:
+    return {kind: TokenBucket(rate, burst)
+            for kind, (rate, burst, _) in RATE_LIMITS.items()}
+
+
+def set_rate_limit(kind, rate, burst, action) -> None:
+    # change a limit at runtime, connected clients are updated too
+    if kind not in RATE_LIMITS or action not in RATE_ACTIONS \
+            or rate < 0 or burst <= 0:
+        raise ValueError(f'invalid rate limit for {kind}')
+    RATE_LIMITS[kind] = [rate, burst, action]
+    for session in list(CLIENTS.values()):
+        session.limiters[kind].rate = rate
+        session.limiters[kind].burst = burst
+
+
+def check_rate(nickname, kind, amount=1) -> bool:
+    # return whether the client may go on with this piece of traffic
+    session = CLIENTS.get(nickname)
+    if session is None:
+        return False
+    limiters = session.limiters
+    wait = limiters[kind].take(amount)
+    if not wait:
+        return True
+    action = RATE_LIMITS[kind][2]
+    if action == 'delay':
+        # only the offending client waits, everybody else keeps going
+        while wait:
+            time.sleep(wait)
+            wait = limiters[kind].take(amount)
+        return True
+    client_socket = session.socket
+    if client_socket not in WRITERS:
+        # already being disconnected
+        return False
+    if action == 'drop':
+        send_to_client(
+            client_socket, f'————> Too many {kind}, the last one was dropped. Please slow down.')
+        return False
+    send_to_client(
+        client_socket, '————> You have been disconnected for flooding the chatroom.')
+    # the handle thread cleans up once the writer shuts the socket down
+    close_writer(client_socket, flush=True)
+    return False
+
+
+def rate_limit_command(client_socket, message) -> None:
+    # /ratelimit lists the limits
+    # /ratelimit <kind> <rate> <burst> <action> changes one of them
+    arguments = message.decode('utf-8').split()[1:]
+    if arguments:
+        try:
+            kind, rate, burst, action = arguments
+            set_rate_limit(kind, float(rate), float(burst), action)
+        except ValueError:
+            send_to_client(
+                client_socket, '————> Usage: /ratelimit <kind> <rate> <burst> <delay|drop|disconnect>')
+            return
+    for kind, (rate, burst, action) in RATE_LIMITS.items():
+        send_to_client(client_socket,
+                       f'————> {kind}: {rate}/s, burst {burst}, {action}')
+
+
+class Transfer:
+    # one upload or download, throttled to its share of the bandwidth
+    def __init__(self, kind, user, client_socket) -> None:
+        self.kind = kind
+        self.user = user
+        self.client_socket = client_socket
+        self.weight = TRANSFER_WEIGHTS[kind]
+        self.bucket = TokenBucket(0, TRANSFER_CHUNK)
+
+    def throttle(self, amount) -> None:
+        # chat frames go out before bulk data
+        deadline = time.monotonic() + CHAT_PRIORITY_WAIT
+        while BUSY_WRITERS and time.monotonic() < deadline:
+            time.sleep(0.001)
+        wait = self.bucket.take(amount)
+        while wait:
+            time.sleep(wait)
+            wait = self.bucket.take(amount)
+
+
+class TransferScheduler:
+    # runs at most MAX_TRANSFERS transfers and MAX_USER_TRANSFERS per user,
+    # the others wait in arrival order and are told their queue position
+    def __init__(self) -> None:
+        self.active = []
+        self.waiting = []
+        self.condition = threading.Condition()
+
+    def acquire(self, transfer) -> None:
+        # block until the transfer may start
+        position = None
+        with self.condition:
+            self.waiting.append(transfer)
+            try:
+                while True:
+                    runnable = self.runnable()
+                    if transfer in runnable:
+                        break
+                    new_position = self.waiting.index(transfer) + 1
+                    if new_position != position:
+                        position = new_position
+                        send_to_client(transfer.client_socket,
+                                       f'\x00QUEUED ({position})')
+                    self.condition.wait()
+            except:
+                self.waiting.remove(transfer)
+                self.condition.notify_all()
+                raise
+            self.waiting.remove(transfer)
+            self.active.append(transfer)
+            self.rebalance()
+            self.condition.notify_all()
+
+    def release(self, transfer) -> None:
+        with self.condition:
+            self.active.remove(transfer)
+            self.rebalance()
+            self.condition.notify_all()
+
+    def runnable(self) -> list:
+        # waiting transfers that would start now, a user at their cap
+        # does not hold back the users behind them
+        running = len(self.active)
+        per_user = dict()
+        for active in self.active:
+            per_user[active.user] = per_user.get(active.user, 0) + 1
+        runnable = []
+        for waiting in self.waiting:
+            if running >= MAX_TRANSFERS:
+                break
+            if per_user.get(waiting.user, 0) >= MAX_USER_TRANSFERS:
+                continue
+            per_user[waiting.user] = per_user.get(waiting.user, 0) + 1
+            running += 1
+            runnable.append(waiting)
+        return runnable
+
+    def rebalance(self) -> None:
+        # split TRANSFER_BANDWIDTH between active transfers by weight
+        total = sum(active.weight for active in self.active)
+        for active in self.active:
+            rate = TRANSFER_BANDWIDTH * active.weight / total
+            active.bucket.rate = rate
+            active.bucket.burst = max(rate / 4, TRANSFER_CHUNK)
+
+
+SCHEDULER = TransferScheduler()
+
+
+class FileStore:
+    # disk usage of LOCATION, updated as uploads come and files go
+    # so the directory never has to be scanned
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.total = 0
+        self.per_user = dict()
+        # token: last use, least recently used first
+        self.used = OrderedDict()
+        # token: upload time
+        self.created = dict()
+        # token: running downloads, pinned files are never evicted
+        self.pinned = dict()
+        # token: (last use, upload time) of files chosen to make room for
+        # an upload in progress, they are only deleted once it is stored
+        self.evicting = dict()
+
+    def reserve(self, owner, size) -> list:
+        # book size bytes for an upload of owner before it starts
+        # return the tokens to evict to make room or None if it does not fit,
+        # they stay on disk until add or release settles the upload
+        with self.lock:
+            evicted = []
+            if STORE_USER_QUOTA and size > STORE_USER_QUOTA or \
+                    STORE_QUOTA and size > STORE_QUOTA:
+                return None
+            if STORE_USER_QUOTA and \
+                    self.per_user.get(owner, 0) + size > STORE_USER_QUOTA:
+                evicted = self.choose_victims(
+                    self.per_user.get(owner, 0) + size - STORE_USER_QUOTA, owner)
+                if evicted is None:
+                    return None
+            freed = sum(FILES[token][3] for token in evicted)
+            if STORE_QUOTA and self.total - freed + size > STORE_QUOTA:
+                victims = self.choose_victims(
+                    self.total - freed + size - STORE_QUOTA, None, evicted)
+                if victims is None:
+                    return None
+                evicted += victims
+            for token in evicted:
+                self.evicting[token] = (self.used[token], self.created[token])
+                self.forget(token)
+            self.total += size
+            self.per_user[owner] = self.per_user.get(owner, 0) + size
+            return evicted
+
+    def release(self, owner, size, evicted=()) -> None:
+        # give back a reservation that was not used,
+        # the files it would have evicted are kept
+        with self.lock:
+            self.total -= size
+            self.per_user[owner] -= size
+            if not self.per_user[owner]:
+                del self.per_user[owner]
+            for token in evicted:
+                self.used[token], self.created[token] = self.evicting.pop(token)
+                file_owner, file_size = FILES[token][2], FILES[token][3]
+                self.total += file_size
+                self.per_user[file_owner] = \
+                    self.per_user.get(file_owner, 0) + file_size
+            if evicted:
+                # back to their place in the least recently used order
+                self.used = OrderedDict(
+                    sorted(self.used.items(), key=lambda item: item[1]))
+
+    def add(self, token, evicted=()) -> None:
+        # a reserved upload finished and is now stored as token,
+        # the caller removes the evicted files
+        with self.lock:
+            self.used[token] = self.created[token] = time.monotonic()
+            for victim in evicted:
+                del self.evicting[victim]
+
+    def choose_victims(self, needed, owner=None, chosen=()) -> list:
+        # files to remove to free needed bytes according to EVICTION_POLICY
+        # only files of owner when given, None if not enough can be freed
+        if EVICTION_POLICY is None:
+            return None
+        candidates = [token for token in self.used
+                      if not self.pinned.get(token) and token not in chosen
+                      and (owner is None or FILES[token][2] == owner)]
+        if EVICTION_POLICY == 'size':
+            candidates.sort(key=lambda token: FILES[token][3], reverse=True)
+        victims = []
+        for token in candidates:
+            if needed <= 0:
+                break
+            victims.append(token)
+            needed -= FILES[token][3]
+        return victims if needed <= 0 else None
+
+    def expired(self) -> list:
+        # remove and return the files older than FILE_TTL
+        with self.lock:
+            deadline = time.monotonic() - FILE_TTL
+            expired = [token for token, created in self.created.items()
+                       if created < deadline and not self.pinned.get(token)]
+            for token in expired:
+                self.forget(token)
+            return expired
+
+    def forget(self, token) -> None:
+        # drop a stored file from the accounting, the caller holds the lock
+        owner, size = FILES[token][2], FILES[token][3]
+        self.total -= size
+        self.per_user[owner] -= size
+        if not self.per_user[owner]:
+            del self.per_user[owner]
+        del self.used[token]
+        del self.created[token]
+
+    def pin(self, token) -> bool:
+        # keep the file while it is being read, False if it is gone already
+        with self.lock:
+            if token not in self.used:
+                return False
+            self.used.move_to_end(token)
+            self.used[token] = time.monotonic()
+            self.pinned[token] = self.pinned.get(token, 0) + 1
+            return True
+
+    def unpin(self, token) -> None:
+        with self.lock:
+            self.pinned[token] -= 1
+            if not self.pinned[token]:
+                del self.pinned[token]
+
+
+STORE = FileStore()
+
+
+def remove_files(tokens) -> None:
+    # delete evicted files and take them off every client's file list
+    for token in tokens:
+        filename, path, _, _, _ = FILES.pop(token)
+        SIGNATURES.pop(token, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        broadcast(
+            f'{filename.decode("utf-8")} has been removed from the server', "SERVER")
+        notify_all(f'\x00REMOVE_FILE ({token})')
+        # a peer file whose owner left is gone with its relayed copy
+        for peer_token, relayed in list(RELAYED.items()):
+            if relayed == token:
+                del RELAYED[peer_token]
+                if PEER_FILES[peer_token][1] not in CLIENTS:
+                    remove_peer_files([peer_token])
+
+
+def remove_peer_files(tokens) -> None:
+    for token in tokens:
+        del PEER_FILES[token]
+        RELAYED.pop(token, None)
+        relay_failed(token, RELAY_WAITING.pop(token, set()))
+        notify_all(f'\x00REMOVE_FILE ({token})')
+
+
+def relay_failed(token, nicknames) -> None:
+    # the relayed copy is not coming, the clients waiting for it stop
+    for nickname in nicknames:
+        if nickname in CLIENTS:
+            send_to_client(CLIENTS[nickname].socket,
+                           f'\x00PEER_FAILED ({token})')
+
+
+def same_subnet(host, other) -> bool:
+    try:
+        network = ipaddress.ip_network(f'{host}/{P2P_PREFIX}', strict=False)
+        return ipaddress.ip_address(other) in network
+    except ValueError:
+        return False
+
+
+def share_file(nickname, message) -> bool:
+    # /share (token) (size) (port) (filename)
+    # False if the message is not this command but a chat message
+    structure = re.compile(r'^/share\s\((\w+)\)\s\((\d+)\)\s\((\d+)\)\s\((.+)\)$')
+    match = structure.match(message.decode('utf-8'))
+    if not match:
+        return False
+    token, size, port, filename = match.groups()
+    # the owner picks the token so it knows which file a ticket is for
+    if token in FILES or token in PEER_FILES:
+        return True
+    PEER_FILES[token] = (filename.encode('utf-8'),
+                         nickname, int(size), int(port))
+    SEARCH.add(b'f', nickname, filename.encode('utf-8'))
+    broadcast(f'{nickname.decode("utf-8")} has shared a file', "SERVER")
+    notify_all(f'\x00UPDATE_PEER_FILE ({filename}) ({token})')
+    return True
+
+
+def fetch_file(client_socket, nickname, message) -> bool:
+    # /fetch (token)
+    # hand out the owner's endpoint and a one-time ticket for the transfer
+    # False if the message is not this command but a chat message
+    match = re.match(r'^/fetch\s\((\w+)\)$', message.decode('utf-8'))
+    if not match:
+        return False
+    token = match.group(1)
+    if token in RELAYED:
+        send_to_client(client_socket,
+                       f'\x00PEER_RELAYED ({token}) ({RELAYED[token]})')
+        return True
+    if token not in PEER_FILES:
+        send_to_client(client_socket, '————> File not found.')
+        return True
+    _, owner, _, port = PEER_FILES[token]
+    if owner not in CLIENTS:
+        send_to_client(client_socket, '————> File not found.')
+        return True
+    owner_host = CLIENTS[owner].address[0]
+    if not same_subnet(owner_host, CLIENTS[nickname].address[0]):
+        relay_file(nickname, token)
+        return True
+    ticket = uuid.uuid4().hex
+    send_to_client(CLIENTS[owner].socket, f'\x00PEER_TICKET ({token}) ({ticket})')
+    send_to_client(client_socket,
+                   f'\x00PEER ({token}) ({owner_host}) ({port}) ({ticket})')
+    return True
+
+
+def relay_file(nickname, token) -> None:
+    # fall back to the server path, the owner uploads a copy once
+    # and everybody waiting for it is told where it is
+    if token in RELAYED:
+        send_to_client(CLIENTS[nickname].socket,
+                       f'\x00PEER_RELAYED ({token}) ({RELAYED[token]})')
+        return
+    if token not in PEER_FILES or PEER_FILES[token][1] not in CLIENTS:
+        relay_failed(token, [nickname])
+        return
+    waiting = RELAY_WAITING.setdefault(token, set())
+    if not waiting:
+        send_to_client(CLIENTS[PEER_FILES[token][1]].socket,
+                       f'\x00PEER_RELAY ({token})')
+    waiting.add(nickname)
+
+
+def expire_files() -> None:
+    while FILE_TTL:
+        time.sleep(EXPIRE_INTERVAL)
+        remove_files(STORE.expired())
+
+
+class SearchIndex:
+    # inverted index over chat history, documents are numbered in arrival
+    # order so every postings list is a sorted array of document numbers
+    # with the term frequencies kept in a parallel byte array
+
+    def __init__(self, path=None) -> None:
+        self.lock = threading.Lock()
+        # POSTINGS[TERM] = (DOCUMENTS, FREQUENCIES)
+        # {str: (array, array)}
+        self.postings = dict()
+        self.times = array('d')
+        self.lengths = array('H')
+        self.kinds = bytearray()
+        self.authors = []
+        self.texts = []
+        self.total_length = 0
+        self.log = None
+        if path is not None:
+            self.load(path)
+            self.log = open(path, 'ab')
+
+    @staticmethod
+    def tokenize(text) -> list:
+        # 'Đường' and 'duong' are the same word to the index
+        text = unicodedata.normalize('NFD', text.lower().replace('đ', 'd'))
+        text = ''.join(char for char in text
+                       if unicodedata.category(char) != 'Mn')
+        return re.findall(r'\w+', text)
+
+    def load(self, path) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            data = file.read()
+        offset = 0
+        while offset + SEARCH_RECORD.size <= len(data):
+            timestamp, kind, author_length, text_length = \
+                SEARCH_RECORD.unpack_from(data, offset)
+            offset += SEARCH_RECORD.size
+            if offset + author_length + text_length > len(data):
+                # a record cut short by a crash
+                break
+            author = data[offset:offset + author_length]
+            offset += author_length
+            text = data[offset:offset + text_length]
+            offset += text_length
+            self.index(kind, author, text, timestamp)
+
+    def add(self, kind, author, text) -> None:
+        # kind is b'm' for a message and b'f' for a file name
+        timestamp = time.time()
+        with self.lock:
+            self.index(kind, author, text, timestamp)
+            if self.log is not None:
+                self.log.write(SEARCH_RECORD.pack(
+                    timestamp, kind, len(author), len(text)) + author + text)
+                self.log.flush()
+
+    def index(self, kind, author, text, timestamp) -> None:
+        document = len(self.texts)
+        terms = self.tokenize(text.decode('utf-8', 'replace'))
+        frequencies = dict()
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+        for term, frequency in frequencies.items():
+            if term not in self.postings:
+                self.postings[term] = (array('I'), array('B'))
+            documents, counts = self.postings[term]
+            documents.append(document)
+            counts.append(min(frequency, 255))
+        self.times.append(timestamp)
+        self.lengths.append(min(len(terms), 65535))
+        self.kinds += kind
+        self.authors.append(author)
+        self.texts.append(text)
+        self.total_length += len(terms)
+
+    def search(self, query, page=1) -> tuple:
+        # every term has to match, the newest SEARCH_CANDIDATES matches
+        # are ranked by BM25 and ties go to the newer document
+        # returns (matches, whether there are more, page of results)
+        terms = list(dict.fromkeys(self.tokenize(query)))
+        with self.lock:
+            if not terms or any(term not in self.postings for term in terms):
+                return 0, False, []
+            lists = sorted((self.postings[term] for term in terms),
+                           key=lambda postings: len(postings[0]))
+            count = len(self.texts)
+            average = self.total_length / count or 1
+            weights = [max(0.0, math.log(
+                (count - len(documents) + 0.5) / (len(documents) + 0.5) + 1))
+                for documents, _ in lists]
+            shortest, others = lists[0], lists[1:]
+            # walking newest to oldest, the other lists only shrink from the end
+            bounds = [len(documents) for documents, _ in others]
+            matches = []
+            position = len(shortest[0])
+            while position and len(matches) < SEARCH_CANDIDATES:
+                position -= 1
+                document = shortest[0][position]
+                frequencies = [shortest[1][position]]
+                for other, (documents, counts) in enumerate(others):
+                    found = bisect.bisect_left(
+                        documents, document, 0, bounds[other])
+                    bounds[other] = found
+                    if found == len(documents) or documents[found] != document:
+                        break
+                    frequencies.append(counts[found])
+                else:
+                    norm = 1.2 * (0.25 + 0.75 *
+                                  self.lengths[document] / average)
+                    score = sum(weight * frequency * 2.2 / (frequency + norm)
+                                for weight, frequency in zip(weights, frequencies))
+                    matches.append((score, document))
+            start = (page - 1) * SEARCH_PAGE
+            ranked = heapq.nlargest(start + SEARCH_PAGE, matches)[start:]
+            return len(matches), position > 0, [
+                (bytes(self.kinds[document:document + 1]), self.authors[document],
+                 self.texts[document], self.times[document])
+                for _, document in ranked]
+
+
+SEARCH = SearchIndex(SEARCH_INDEX_PATH)
+
+
+def search_command(client_socket, message) -> None:
+    # /search <words> shows the first page, /search (page) <words> another one
+    match = re.match(r'^/search\s+(?:\((\d+)\)\s+)?(.+)$',
+                     message.decode('utf-8'))
+    if not match:
+        send_to_client(client_socket, '————> Usage: /search [(page)] <words>')
+        return
+    page = max(1, int(match.group(1) or 1))
+    query = match.group(2).strip()
+    total, more, results = SEARCH.search(query, page)
+    pages = max(1, -(-total // SEARCH_PAGE))
+    send_to_client(client_socket,
+                   f'————> {total}{"+" if more else ""} results for "{query}" (page {page}/{pages})')
+    for kind, author, text, timestamp in results:
+        when = time.strftime('%d/%m %H:%M', time.localtime(timestamp))
+        text = text.decode('utf-8', 'replace')
+        if kind == b'f':
+            text = f'shared {text}'
+        elif len(text) > 200:
+            text = text[:200] + '...'
+        send_to_client(client_socket,
+                       f'————> [{when}] {author.decode("utf-8")}: {text}')
 
 
 # broadcast messages to all clients
@@ -86,47 +1014,269 @@ def broadcast(message, nickname, sender=None) -> None:
         notification = (85-len(message))//2 * ' '  \
             + '-'*6 + "   " + message + "   " + '-' * \
             6 + (85-len(message))//2 * ' '+'\n'
-        for client_socket, address in CLIENTS.values():
-            send_to_client(client_socket, notification)
+        notify_all(notification)
     else:
-        for client_socket, address in CLIENTS.values():
-            if client_socket is not sender:
-                send_to_client(client_socket,
-                               f'[{nickname.decode("utf-8")}]: {message.decode("utf-8")}')
+        frames = frame_message(
+            f'[{nickname.decode("utf-8")}]: {message.decode("utf-8")}')
+        for session in CLIENTS.values():
+            if session.socket is not sender:
+                send_frames_to_client(session.socket, frames)
 
 # handle client messages
 
 
-def handle(client_socket, nickname) -> None:
+def handle(client_socket, session) -> None:
+    nickname = session.nickname
     while True:
         try:
             # receive message from client
-            message = client_socket.recv(1024)
+            message = recv_frame(client_socket).rstrip(b'\x00')
+            session.frames_in += 1
+            session.bytes_in += len(message)
+            if message == b'\x00LEAVE':
+                # the client quit, its session is not kept for a resume
+                # it leaves CLIENTS before its writer goes, so no broadcast
+                # falls back to writing to the closed socket
+                capture(client_socket, b'c')
+                leave(nickname)
+                close_writer(client_socket)
+                client_socket.close()
+                break
+            if not check_rate(nickname, 'messages') or \
+                    not check_rate(nickname, 'bytes', len(message)):
+                continue
             if message.startswith((b'/private')):
-                private_message(client_socket, nickname, message)
+                if check_rate(nickname, 'private'):
+                    private_message(client_socket, nickname, message)
+                continue
+            # a message that only starts like a command is chat
+            if message.startswith(b'/share') and share_file(nickname, message):
+                continue
+            if message.startswith(b'/fetch') and \
+                    fetch_file(client_socket, nickname, message):
+                continue
+            fallback = re.match(rb'^/fallback\s\((\w+)\)$', message)
+            if fallback:
+                relay_file(nickname, fallback.group(1).decode('utf-8'))
+                continue
+            if re.match(rb'^/search(\s|$)', message):
+                search_command(client_socket, message)
+                continue
+            if message.startswith(b'/ratelimit') and \
+                    session.address[0] in ADMIN_HOSTS:
+                rate_limit_command(client_socket, message)
+                continue
+            if message.startswith(b'/memory') and \
+                    session.address[0] in ADMIN_HOSTS:
+                memory_command(client_socket, message)
                 continue
             # public message- broadcast to all clients
+            SEARCH.add(b'm', nickname, message)
             broadcast(message, nickname, client_socket)
         except:
-            # remove client from CLIENTS
-            del CLIENTS[nickname]
-            # notify to all clients
-            broadcast(
-                f'{nickname.decode("utf-8")} left the chatroom!', "SERVER")
-            # notify all clients to update their client list
-            for client_socket, _ in CLIENTS.values():
-                send_to_client(client_socket, '\x00REMOVE ' +
-                               f"({nickname.decode('utf-8')})")
+            capture(client_socket, b'c')
+            # give the client a moment to come back before it leaves
+            detach_session(client_socket, nickname)
             break
 
 
+def close_writer(client_socket, flush=False) -> None:
+    writer = WRITERS.pop(client_socket, None)
+    if writer is not None:
+        writer.close(flush)
+
+
+def detach_session(client_socket, nickname) -> None:
+    with SESSION_LOCK:
+        if nickname not in CLIENTS or CLIENTS[nickname].socket is not client_socket:
+            # the session already moved on to a new connection
+            client_socket.close()
+            return
+        writer = WRITERS.get(client_socket)
+        if writer is not None:
+            # frames for the client are numbered and buffered meanwhile
+            writer.detach()
+            DETACHED[nickname] = writer
+    client_socket.close()
+    if writer is None:
+        # disconnected on purpose, no way back
+        leave(nickname)
+        return
+    timer = threading.Timer(
+        RESUME_GRACE, expire_session, args=(nickname, writer))
+    timer.daemon = True
+    timer.start()
+
+
+def expire_session(nickname, writer) -> None:
+    with SESSION_LOCK:
+        if DETACHED.get(nickname) is not writer:
+            # resumed in time
+            return
+        del DETACHED[nickname]
+        # a closed writer refuses a late resume and drops what is
+        # broadcast until the session is gone from CLIENTS
+        writer.close()
+        client_socket = CLIENTS[nickname].socket
+    leave(nickname)
+    WRITERS.pop(client_socket, None)
+
+
+def resume_session(client_socket, address, token, received) -> bool:
+    # move a session to the new connection of its client
+    with SESSION_LOCK:
+        nickname = SESSIONS.get(token)
+        if nickname not in CLIENTS:
+            return False
+        session = CLIENTS[nickname]
+        old_socket = session.socket
+        writer = WRITERS.get(old_socket)
+        if writer is None or not writer.attach(
+                client_socket, received, frame_message('\x00RESUMED')):
+            return False
+        # the old handle thread may still wait on the dead connection
+        shutdown_socket(old_socket)
+        del WRITERS[old_socket]
+        WRITERS[client_socket] = writer
+        session.socket = client_socket
+        session.address = address
+        DETACHED.pop(nickname, None)
+    thread = threading.Thread(
+        target=handle, args=(client_socket, session))
+    thread.start()
+    return True
+
+
+def leave(nickname) -> None:
+    # remove client from CLIENTS
+    session = CLIENTS.pop(nickname)
+    SESSIONS.pop(session.token, None)
+    # files shared from the client's machine are gone with it
+    remove_peer_files([token for token, (_, owner, _, _) in PEER_FILES.items()
+                       if owner == nickname and token not in RELAYED])
+    # notify to all clients
+    broadcast(
+        f'{nickname.decode("utf-8")} left the chatroom!', "SERVER")
+    # notify all clients to update their client list
+    notify_all(f"\x00REMOVE ({nickname.decode('utf-8')})")
+
+
+class Session:
+    # everything the server keeps for one chat client, slots keep the
+    # per-connection cost down to the attributes themselves
+    __slots__ = ('nickname', 'socket', 'address', 'token', 'writer',
+                 'limiters', 'frames_in', 'bytes_in', 'connected')
+
+    def __init__(self, nickname, client_socket, address) -> None:
+        self.nickname = nickname
+        self.socket = client_socket
+        self.address = address
+        self.token = uuid.uuid4().hex
+        self.writer = ConnectionWriter(client_socket)
+        self.limiters = create_limiters()
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.connected = time.time()
+
+    def memory(self, frames=None) -> dict:
+        # bytes held for the session, frames of a broadcast are shared
+        # between sessions, pass a dict to collect them by id
+        # stacks is the address space reserved for the threads of the
+        # session, only the pages they touch become resident
+        writer = self.writer
+        with writer.condition:
+            queued = list(writer.pending)
+            buffered = list(writer.replay)
+            connected = writer.client_socket is not None
+        held = dict()
+        for frame in buffered + queued:
+            held[id(frame)] = sys.getsizeof(frame)
+        if frames is not None:
+            frames.update(held)
+        objects = sum(map(sys.getsizeof, (
+            self, self.nickname, self.address, self.token, self.limiters,
+            self.socket, writer, writer.pending, writer.replay,
+            writer.condition, writer.condition._lock)))
+        objects += sum(sys.getsizeof(limiter) + sys.getsizeof(limiter.lock)
+                       for limiter in self.limiters.values())
+        # the writer thread, and the handle thread while connected,
+        # which is built the same way
+        threads = 2 if connected else 1
+        objects += threads * thread_size(writer.thread)
+        return {'objects': objects, 'frames': sum(held.values()),
+                'threads': threads, 'stacks': threads * THREAD_STACK_SIZE,
+                'queued': len(queued), 'buffered': len(buffered)}
+
+
+def thread_size(thread) -> int:
+    # the thread object with its attributes and the locks it waits on
+    attributes = vars(thread)
+    return sys.getsizeof(thread) + sys.getsizeof(attributes) + \
+        sum(map(sys.getsizeof, attributes.values())) + \
+        sys.getsizeof(thread._started._cond) + \
+        sys.getsizeof(thread._started._cond._lock)
+
+
+def start_session(client_socket, address, nickname) -> Session:
+    # register a chat client and issue its session token, which is
+    # frame 1 of the session, queued before any broadcast can reach it
+    session = Session(nickname, client_socket, address)
+    session.writer.write(frame_message(f'\x00SESSION ({session.token})'))
+    WRITERS[client_socket] = session.writer
+    CLIENTS[nickname] = session
+    SESSIONS[session.token] = nickname
+    return session
+
+
+def format_size(size) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+        size /= 1024
+    return f'{size:.1f} GiB'
+
+
+def memory_command(client_socket, message) -> None:
+    # /memory shows the total and the MEMORY_REPORT largest sessions
+    # /memory <nickname> shows one session
+    arguments = message.decode('utf-8').split(maxsplit=1)[1:]
+    sessions = list(CLIENTS.values())
+    if arguments:
+        sessions = [session for session in sessions
+                    if session.nickname == arguments[0].encode('utf-8')]
+        if not sessions:
+            send_to_client(
+                client_socket, '————> User not found. Please try again.')
+            return
+    frames = dict()
+    usage = [(session, session.memory(frames)) for session in sessions]
+    objects = sum(memory['objects'] for _, memory in usage)
+    threads = sum(memory['threads'] for _, memory in usage)
+    stacks = sum(memory['stacks'] for _, memory in usage)
+    send_to_client(client_socket,
+                   f'————> {len(usage)} sessions: {format_size(objects + sum(frames.values()) + stacks)} '
+                   f'({format_size(objects)} state and threads, {len(frames)} frames {format_size(sum(frames.values()))}, '
+                   f'{threads} thread stacks {format_size(stacks)} reserved), '
+                   f'{threading.active_count()} threads in the server')
+    usage.sort(key=lambda item: item[1]['objects'] + item[1]['frames'],
+               reverse=True)
+    for session, memory in usage[:MEMORY_REPORT]:
+        sent = session.writer.sequence
+        send_to_client(client_socket,
+                       f'————> {session.nickname.decode("utf-8")}: '
+                       f'{format_size(memory["objects"] + memory["frames"] + memory["stacks"])} '
+                       f'({memory["buffered"]} frames buffered, {memory["queued"]} queued, '
+                       f'{memory["threads"]} threads {format_size(memory["stacks"])} stack reserved), '
+                       f'in {session.frames_in} frames/{format_size(session.bytes_in)}, '
+                       f'out {sent} frames/{format_size(sent * FRAME_SIZE)}, '
+                       f'up {int(time.time() - session.connected)}s')
+
+
 # update client list
 
 def update_client_list(new_client, storing_nickname) -> None:
     display_nickname = storing_nickname.decode('utf-8')
-    for client_socket, _ in CLIENTS.values():
-        send_to_client(client_socket, '\x00UPDATE ' +
-                       f"({display_nickname})")
+    notify_all(f'\x00UPDATE ({display_nickname})')
     for user in CLIENTS:
         if user != storing_nickname:
             send_to_client(new_client, '\x00UPDATE ' +
@@ -136,20 +1286,47 @@ def update_client_list(new_client, storing_nickname) -> None:
 # on connect new client
 
 def on_connect(client_socket, address) -> None:
+    # send small notifications right away instead of waiting for Nagle,
+    # batching is done by the connection writer
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     # request and store nickname
     try:
         storing_nickname = client_socket.recv(1024)  # bytes
+        if storing_nickname.startswith(mux.MUX_MAGIC):
+            if MULTIPLEX:
+                on_multiplexed(client_socket, address,
+                               storing_nickname[len(mux.MUX_MAGIC):])
+            else:
+                client_socket.close()
+            return
+        capture_open(client_socket, b'chat')
+        capture(client_socket, b'n', storing_nickname)
+        # a client coming back after losing its connection:
+        # \x00RESUME (session token) (frames received)
+        resume = re.match(rb'^\x00RESUME \((\w+)\) \((\d+)\)$',
+                          storing_nickname)
+        if resume:
+            token, received = resume.groups()
+            if not resume_session(client_socket, address,
+                                  token.decode('utf-8'), int(received)):
+                send_to_client(client_socket, '\x00RESUME_FAILED')
+                capture(client_socket, b'c')
+                client_socket.close()
+            return
         display_nickname = storing_nickname.decode('utf-8')  # string
 
         # check if nickname is already taken
         while storing_nickname in CLIENTS:
-            client_socket.send(
-                'RESEND_NICK'.encode('utf-8'))
+            send_to_client(client_socket, 'RESEND_NICK')
             storing_nickname = client_socket.recv(1024)
+            capture(client_socket, b'n', storing_nickname)
             display_nickname = storing_nickname.decode('utf-8')
+        if not storing_nickname:
+            raise ConnectionError('connection closed')
 
         # store client information
-        CLIENTS[storing_nickname] = (client_socket, address)
+        session = start_session(client_socket, address, storing_nickname)
+        capture(client_socket, b's', session.token.encode('utf-8'))
 
         # notify to all clients
         broadcast(f'{display_nickname} joined the chatroom!', "SERVER")
@@ -160,11 +1337,31 @@ def on_connect(client_socket, address) -> None:
         update_thread.start()
         # start thread for handling client
         thread = threading.Thread(
-            target=handle, args=(client_socket, storing_nickname))
+            target=handle, args=(client_socket, session))
         thread.start()
     except:
+        capture(client_socket, b'c')
+        close_writer(client_socket)
         return
 
+def on_multiplexed(client_socket, address, data) -> None:
+    # every stream the client opens is served like a connection
+    # to the listener of its channel
+    def open_stream(stream, channel) -> None:
+        if channel == b'chat':
+            thread = threading.Thread(
+                target=on_connect, args=(stream, address))
+        elif channel == b'upload':
+            thread = threading.Thread(target=on_file_upload, args=(stream,))
+        elif channel == b'download':
+            thread = threading.Thread(target=on_file_download, args=(stream,))
+        else:
+            stream.close()
+            return
+        thread.start()
+
+    mux.Multiplexer(client_socket, open_stream, data)
+
 # start accepting clients
 
 
@@ -182,15 +1379,140 @@ def accept_chat() -> None:
 # listen for file upload
 
 
+def set_transfer_priority(client_socket) -> None:
+    # mark bulk traffic for routers, chat sockets stay in the default class
+    try:
+        client_socket.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, 0x08)
+    except (AttributeError, OSError):
+        pass
+
+
+class BlockSigner:
+    # digest and block signatures of a file, fed while its content streams
+    # by so the file is never read twice
+    def __init__(self) -> None:
+        self.digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        self.signatures = bytearray()
+        self.block = bytearray()
+
+    def update(self, data) -> None:
+        self.digest.update(data)
+        self.block += data
+        if len(self.block) >= BLOCK_SIZE:
+            view = memoryview(self.block)
+            start = 0
+            while len(self.block) - start >= BLOCK_SIZE:
+                self.sign(view[start:start + BLOCK_SIZE])
+                start += BLOCK_SIZE
+            view.release()
+            del self.block[:start]
+
+    def sign(self, block) -> None:
+        self.signatures += SIGNATURE.pack(
+            zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest())
+
+    def finish(self) -> bytes:
+        # sign the last, shorter block
+        if self.block:
+            self.sign(self.block)
+            self.block = bytearray()
+        return bytes(self.signatures)
+
+
+def receive_plain(client_socket, file, signer, size, transfer) -> int:
+    # store the content as it comes, never more than the declared size
+    received = 0
+    while received < size:
+        data = client_socket.recv(min(TRANSFER_CHUNK, size - received))
+        if not data:
+            break
+        capture_file_data(client_socket, data)
+        file.write(data)
+        signer.update(data)
+        received += len(data)
+        transfer.throttle(len(data))
+    return received
+
+
+def receive_delta(client_socket, file, signer, base_path, size, transfer) -> int:
+    # rebuild a new version from blocks of the base file and literal data
+    received = 0
+    base = open(base_path, 'rb') if base_path else None
+    try:
+        while True:
+            kind, value = DELTA_HEADER.unpack(
+                recv_exact(client_socket, DELTA_HEADER.size))
+            if kind == b'E':
+                return received
+            if kind == b'B' and base is not None:
+                base.seek(value * BLOCK_SIZE)
+                data = base.read(BLOCK_SIZE)
+            elif kind == b'L' and 0 < value <= TRANSFER_CHUNK:
+                data = recv_exact(client_socket, value, None)
+                capture_file_data(client_socket, data)
+                transfer.throttle(value)
+            else:
+                raise ValueError('invalid delta instruction')
+            received += len(data)
+            if not data or received > size:
+                raise ValueError('delta does not match the declared size')
+            file.write(data)
+            signer.update(data)
+    finally:
+        if base is not None:
+            base.close()
+
+
 def on_file_upload(client_socket) -> None:
+    command = None
+    transfer = None
+    reserved = None
+    path = None
+    base = None
+    evicted = []
+    capture_open(client_socket, b'upload')
     try:
-        metadata = client_socket.recv(2048)
-        # /upload (filename) (sender)
-        structure = re.compile(r'^(/upload)\s\((.{2,16})\)\s\((.+)\).*$')
-        _, sender, filename = structure.match(
-            metadata.decode('utf-8')).groups()
+        set_transfer_priority(client_socket)
+        metadata = recv_frame(client_socket).rstrip(b'\x00').decode('utf-8')
+        if metadata.startswith('/delta'):
+            # /delta (sender) (filename) (size) (base token)
+            # a new version of a stored file, only changed blocks are sent
+            structure = re.compile(
+                r'^(/delta)\s\((.{2,16})\)\s\((.+)\)\s\((\d+)\)\s\((\w+)\)$')
+            command, sender, filename, size, base = structure.match(
+                metadata).groups()
+            # the base file is kept while it is read
+            if not STORE.pin(base):
+                base = None
+        else:
+            # /upload (sender) (filename) (size)
+            # or /relay (sender) (peer token) (size) for a copy of a peer file
+            structure = re.compile(
+                r'^(/upload|/relay)\s\((.{2,16})\)\s\((.+)\)\s\((\d+)\)$')
+            command, sender, filename, size = structure.match(
+                metadata).groups()
+        owner, size = sender.encode('utf-8'), int(size)
+        if command == '/relay':
+            relay_token = filename
+            if relay_token not in PEER_FILES or PEER_FILES[relay_token][1] != owner:
+                return
+            filename = PEER_FILES[relay_token][0].decode('utf-8')
+        # only connected clients may upload, within their upload limit
+        if not check_rate(owner, 'uploads'):
+            send_to_client(client_socket, 'RATE_LIMITED')
+            return
+
+        # book the declared size before anything is sent
+        evicted = STORE.reserve(owner, size)
+        if evicted is None:
+            send_to_client(client_socket, 'QUOTA_EXCEEDED')
+            return
+        reserved = size
 
-        client_socket.send('READY'.encode('utf-8'))
+        # wait for a free transfer slot
+        transfer = Transfer('upload', owner, client_socket)
+        SCHEDULER.acquire(transfer)
+        send_to_client(client_socket, 'READY')
         # open directory for file storing
         if not os.path.exists(LOCATION):
             os.makedirs(LOCATION)
@@ -198,25 +1520,70 @@ def on_file_upload(client_socket) -> None:
         TOKEN = uuid.uuid4().hex
         while TOKEN in FILES:
             TOKEN = uuid.uuid4().hex
+        path = os.path.join(LOCATION, f'{TOKEN}.{filename.split(".")[-1]}')
+        signer = BlockSigner()
+        with open(path, 'wb') as file:
+            if command == '/delta':
+                # tell the sender which blocks the server already has
+                signatures = SIGNATURES.get(base, b'') if base else b''
+                send_to_client(
+                    client_socket, f'({BLOCK_SIZE}) ({len(signatures) // SIGNATURE.size})')
+                client_socket.sendall(signatures)
+                received = receive_delta(client_socket, file, signer,
+                                         FILES[base][1] if base else None, size, transfer)
+            else:
+                received = receive_plain(
+                    client_socket, file, signer, size, transfer)
+        SCHEDULER.release(transfer)
+        transfer = None
+        if received != size:
+            return
+        # the sender follows the content with the digest it computed
+        digest = signer.digest.hexdigest()
+        trailer = recv_frame(client_socket).rstrip(b'\x00').decode('utf-8')
+        if trailer != f'({digest})':
+            send_to_client(client_socket, 'DAMAGED')
+            return
+        send_to_client(client_socket, 'SAVED')
+        capture(client_socket, b't', TOKEN.encode('utf-8'))
         # store file information
-        FILES[TOKEN] = (
-            filename.encode('utf-8'), f'{LOCATION}/{TOKEN}.{filename.split(".")[-1]}', sender.encode('utf-8'))
-        # store file in the directory
-        with open(f'{FILES[TOKEN][1]}', 'wb') as file:
-            while True:
-                data = client_socket.recv(1024)
-                if not data:
-                    break
-                file.write(data)
+        FILES[TOKEN] = (filename.encode('utf-8'), path, owner, size, digest)
+        SIGNATURES[TOKEN] = signer.finish()
+        STORE.add(TOKEN, evicted)
+        reserved = path = None
+        remove_files(evicted)
+        if command == '/relay':
+            # the copy is only announced to the clients waiting for it
+            RELAYED[relay_token] = TOKEN
+            for nickname in RELAY_WAITING.pop(relay_token, set()):
+                if nickname in CLIENTS:
+                    send_to_client(CLIENTS[nickname].socket,
+                                   f'\x00PEER_RELAYED ({relay_token}) ({TOKEN})')
+            return
+        SEARCH.add(b'f', owner, FILES[TOKEN][0])
         # notify the sender that the file has been uploaded
         broadcast(
             f'{sender} has uploaded a file', "SERVER")
         # update the file list for all clients
-        for client_socket, _ in CLIENTS.values():
-            send_to_client(client_socket, '\x00UPDATE_FILE ' +
-                           f"({filename}) ({TOKEN})")
+        notify_all(
+            f'\x00UPDATE_FILE ({filename}) ({TOKEN}) ({FILES[TOKEN][4]})')
     except:
         return
+    finally:
+        if transfer is not None:
+            SCHEDULER.release(transfer)
+        # drop what is left of an upload that did not complete
+        if reserved is not None:
+            STORE.release(owner, reserved, evicted)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+        # let the next fallback request ask the owner again
+        if command == '/relay' and relay_token not in RELAYED:
+            relay_failed(relay_token, RELAY_WAITING.pop(relay_token, set()))
+        if base is not None:
+            STORE.unpin(base)
+        capture(client_socket, b'c')
+        client_socket.close()
 
 
 def accept_file_upload() -> None:
@@ -232,22 +1599,45 @@ def accept_file_upload() -> None:
 
 # listen for file download
 def on_file_download(client_socket) -> None:
+    transfer = None
+    TOKEN = None
+    capture_open(client_socket, b'download')
     try:
-        TOKEN = client_socket.recv(1024).decode('utf-8')
-        if TOKEN not in FILES:
+        set_transfer_priority(client_socket)
+        request = recv_frame(client_socket).rstrip(b'\x00')
+        # /download (receiver) (token)
+        structure = re.compile(r'^(/download)\s\((.{2,16})\)\s\((\w+)\)$')
+        _, receiver, token = structure.match(request.decode('utf-8')).groups()
+        # keep the file from being evicted while it is sent
+        if not STORE.pin(token):
             return
-        client_socket.send(FILES[TOKEN][0])
+        TOKEN = token
+
+        # wait for a free transfer slot
+        transfer = Transfer('download', receiver.encode('utf-8'), client_socket)
+        SCHEDULER.acquire(transfer)
+        # (filename) (size) (digest)
+        filename, _, _, size, digest = FILES[TOKEN]
+        send_to_client(client_socket,
+                       f'({filename.decode("utf-8")}) ({size}) ({digest})')
 
         # send file content to client
         with open(f'{FILES[TOKEN][1]}', 'rb') as file:
             while True:
-                data = file.read(1024)
+                data = file.read(TRANSFER_CHUNK)
                 if not data:
                     break
-                client_socket.send(data)
-        client_socket.close()
+                transfer.throttle(len(data))
+                client_socket.sendall(data)
     except:
         return
+    finally:
+        if transfer is not None:
+            SCHEDULER.release(transfer)
+        if TOKEN is not None:
+            STORE.unpin(TOKEN)
+        capture(client_socket, b'c')
+        client_socket.close()
 
 
 def accept_file_download() -> None:
@@ -265,6 +1655,22 @@ if __name__ == '__main__':
     import tkinter as tk
     import sys
     import shutil
+
+    # allow only one instance of the chat_server to run
+    try:
+        chat_server.bind((CHAT_HOST, CHAT_PORT))
+        file_upload_server.bind((FILE_UPLOAD_HOST, FILE_UPLOAD_PORT))
+        file_download_server.bind((FILE_DOWNLOAD_HOST, FILE_DOWNLOAD_PORT))
+    except:
+        ctypes.windll.user32.MessageBoxW(
+            0, "Another instance of the server is already running!", "Error", 1)
+        sys.exit(0)
+
+    # listen for clients
+    chat_server.listen()
+    file_upload_server.listen()
+    file_download_server.listen()
+
     root = tk.Tk()
 
     def on_closing():
@@ -272,8 +1678,11 @@ if __name__ == '__main__':
         chat_server.close()
         file_upload_server.close()
         file_download_server.close()
-        for client_socket, _ in CLIENTS.values():
-            client_socket.close()
+        for session in CLIENTS.values():
+            session.socket.close()
+        if CAPTURE is not None:
+            with CAPTURE.lock:
+                CAPTURE.file.close()
         if os.path.exists(LOCATION):
             shutil.rmtree(LOCATION)
         sys.exit(0)
@@ -302,4 +1711,8 @@ if __name__ == '__main__':
     accept_file_download_thread = threading.Thread(target=accept_file_download)
     accept_file_download_thread.start()
 
+    # remove files that outlived FILE_TTL
+    expire_files_thread = threading.Thread(target=expire_files, daemon=True)
+    expire_files_thread.start()
+
     root.mainloop()